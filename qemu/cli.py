@@ -7,9 +7,11 @@ import subprocess
 import time
 
 from . import __version__
+from .hypervisor_agent import HypervisorAgent
 from .hypervisor_ssh import HypervisorSSH
 from .specs import NetworkSpec
 from .specs import VmSpec
+from .vms import Vm
 
 
 def read_config(ctx, param, value):
@@ -36,6 +38,30 @@ def sizeof_fmt(num, suffix='B'):
     return '{:3.1f}{}{}'.format(val, ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi'][magnitude], suffix)
 
 
+def run_vms(ctx, hypervisor, names, action, verb, parallel):
+    vms = hypervisor.vms.select(names)
+    if not vms:
+        ctx.fail(f"No vms match {' '.join(names)}")
+    return report_vms(ctx, hypervisor, hypervisor.vms.run(vms, action, parallel), len(vms), verb)
+
+
+def report_vms(ctx, hypervisor, results, total, verb):
+    failed = 0
+    done = []
+    for count, (vm, error) in enumerate(results, 1):
+        name = getattr(vm, "name", vm)
+        progress = f"[{count}/{total}] " if total > 1 else ""
+        if error:
+            failed += 1
+            click.echo(f"{progress}Vm {name} failed: {error}", err=True)
+        else:
+            done.append(hypervisor.vms.vm(name))
+            click.echo(f"{progress}Vm {name} {verb}")
+    if failed:
+        ctx.exit(1)
+    return done
+
+
 pass_hypervisor = click.make_pass_decorator(HypervisorSSH)
 
 
@@ -45,15 +71,19 @@ pass_hypervisor = click.make_pass_decorator(HypervisorSSH)
 @click.option("--vnc-command", help="The vnc program to execute")
 @click.option("--vnc-address", help="The vnc program to execute")
 @click.option("--vnc-password", help="The vnc program to execute")
+@click.option("--ssh-sessions", default=8, help="Maximum number of concurrent commands per ssh connection")
+@click.option("--ssh-connections", default=1, help="Number of ssh connections to the hypervisor")
+@click.option("--agent/--no-agent", default=False, help="Run a resident helper on the hypervisor and send all operations to it")
 @click.option("-v", "--verbose", count=True, help="Verbose logging, repeat to increase verbosity")
 @click.version_option(version=__version__)
 @click.pass_context
-def cli(ctx, verbose, config, vnc_command, vnc_address, vnc_password, hypervisor):
+def cli(ctx, verbose, config, vnc_command, vnc_address, vnc_password, ssh_sessions, ssh_connections, agent, hypervisor):
     """
     Manage virtual machines using qemu.
     """
     logging.basicConfig(level=max(30 - verbose * 10, 10), format="[%(asctime)-15s] [%(levelname)s] %(message)s")
-    ctx.obj = HypervisorSSH(hypervisor, vnc_address=vnc_address, vnc_password=vnc_password)
+    ctx.obj = (HypervisorAgent if agent else HypervisorSSH)(hypervisor, vnc_address=vnc_address, vnc_password=vnc_password, max_sessions=ssh_sessions, connections=ssh_connections)
+    ctx.call_on_close(ctx.obj.close)
 
 
 @cli.command("check")
@@ -63,14 +93,8 @@ def check(hypervisor):
     Check if the hypervisor meets the requirements.
     """
     click.echo("Check binaries:")
-    click.echo(" - {}".format(hypervisor.exec(["type", "find"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "install"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "socat"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "dnsmasq"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "ip"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "qemu-system-x86_64"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "qemu-img"]).strip()))
-    click.echo(" - {}".format(hypervisor.exec(["type", "iptables"]).strip()))
+    for binary in ["find", "install", "socat", "dnsmasq", "ip", "qemu-system-x86_64", "qemu-img", "iptables", "python3"]:
+        click.echo(" - {} is {}".format(binary, hypervisor.exec(["sh", "-c", f"command -v {binary}"]).strip()))
     click.echo("Check ip forwarding:")
     click.echo(" - {}".format(hypervisor.exec(["sysctl", "net.ipv4.ip_forward"]).strip()))
 
@@ -90,12 +114,15 @@ def vms_list(hypervisor, details):
     """
     List virtual machines.
     """
-    for vm in hypervisor.vms.all():
-        click.echo("\t".join([
+    for vm, running, spec in hypervisor.vms.inventory():
+        columns = [
             vm.name.ljust(30),
-            ("running" if vm.is_running else "stopped").rjust(8),
-            vm.spec["memory"]["size"].rjust(8),
-        ]))
+            ("running" if running else "stopped").rjust(8),
+            (spec["memory"]["size"] if spec else "-").rjust(8),
+        ]
+        if details:
+            columns.append(", ".join(vm.addresses_for(spec) if spec else []) or "-")
+        click.echo("\t".join(columns))
 
 
 @vms.command("show")
@@ -115,7 +142,7 @@ def vms_show(hypervisor, name):
         click.echo(f"Display: {vm.vnc_uri}")
     else:
         click.echo("Status: stopped")
-    click.echo(f"Ip: {vm.address}")
+    click.echo(f"Ip: {', '.join(vm.addresses) or None}")
     if spec["drives"]:
         click.echo("Drives:")
         for drive in spec["drives"]:
@@ -239,36 +266,78 @@ def vms_create(ctx, hypervisor, console, as_json, dry_run, **spec):
         subprocess.run(ctx.find_root().params["vnc_command"].format(vm.vnc_uri), shell=True)
 
 
+@vms.command("clone")
+@click.option("--start", is_flag=True, help="Start the clones after creating them")
+@click.option("--parallel", default=8, help="Number of clones to create at the same time")
+@click.argument("source")
+@click.argument("names", nargs=-1, required=True)
+@pass_hypervisor
+@click.pass_context
+def vms_clone(ctx, hypervisor, start, parallel, source, names):
+    """
+    Clone a stopped virtual machine.
+
+    The disks of the source machine are copied once into an immutable
+    template under images/templates. Every clone gets thin qcow2 overlays
+    (or reflink copies for raw disks) on top of it, a new uuid and new
+    mac addresses.
+    """
+    clones = report_vms(ctx, hypervisor, hypervisor.vms.clone(source, names, parallel), len(names), "created")
+    if start:
+        run_vms(ctx, hypervisor, [clone.name for clone in clones], Vm.start, "started", parallel)
+
+
+@vms.command("events")
+@click.option("--timeout", type=float, help="Stop after this many seconds without events")
+@click.argument("names", nargs=-1, required=True)
+@pass_hypervisor
+@click.pass_context
+def vms_events(ctx, hypervisor, timeout, names):
+    """
+    Stream qmp events of virtual machines as json lines.
+
+    NAMES may contain glob patterns. Events of all matching vms are merged
+    into one stream as they arrive.
+    """
+    vms = hypervisor.vms.select(names)
+    if not vms:
+        ctx.fail(f"No vms match {' '.join(names)}")
+    for vm, event in hypervisor.vms.events(vms, timeout):
+        click.echo(json.dumps(dict(event, vm=vm.name)))
+
+
 @vms.command("start")
 @click.option("--console/--no-console", is_flag=True, default=True, help="Open the VNC console after starting the machine")
-@click.argument("name")
+@click.option("--parallel", default=8, help="Number of machines to start at the same time")
+@click.argument("names", nargs=-1, required=True)
 @pass_hypervisor
 @click.pass_context
-def vms_start(ctx, hypervisor, console, name):
+def vms_start(ctx, hypervisor, console, parallel, names):
     """
-    Start a virtual machine.
+    Start one or more virtual machines.
+
+    Names can be glob patterns, for example `web-*`.
     """
-    vm = hypervisor.vms.get(name)
-    vm.start()
-    click.echo(f"Vm {name} started")
-    if console and ctx.find_root().params["vnc_command"]:
-        subprocess.run(ctx.find_root().params["vnc_command"].format(vm.vnc_uri), shell=True)
+    vms = run_vms(ctx, hypervisor, names, Vm.start, "started", parallel)
+    if console and len(vms) == 1 and ctx.find_root().params["vnc_command"]:
+        subprocess.run(ctx.find_root().params["vnc_command"].format(vms[0].vnc_uri), shell=True)
 
 
 @vms.command("restart")
 @click.option("--console/--no-console", is_flag=True, default=True, help="Open the VNC console after restarting the machine")
-@click.argument("name")
+@click.option("--parallel", default=8, help="Number of machines to restart at the same time")
+@click.argument("names", nargs=-1, required=True)
 @pass_hypervisor
 @click.pass_context
-def vms_restart(ctx, hypervisor, console, name):
+def vms_restart(ctx, hypervisor, console, parallel, names):
     """
-    Restart a virtual machine.
+    Restart one or more virtual machines.
+
+    Names can be glob patterns, for example `web-*`.
     """
-    vm = hypervisor.vms.get(name)
-    vm.restart()
-    click.echo(f"Vm {name} restarted")
-    if console and ctx.find_root().params["vnc_command"]:
-        subprocess.run(ctx.find_root().params["vnc_command"].format(vm.vnc_uri), shell=True)
+    vms = run_vms(ctx, hypervisor, names, Vm.restart, "restarted", parallel)
+    if console and len(vms) == 1 and ctx.find_root().params["vnc_command"]:
+        subprocess.run(ctx.find_root().params["vnc_command"].format(vms[0].vnc_uri), shell=True)
 
 
 @vms.command("recreate")
@@ -291,15 +360,17 @@ def vms_recreate(ctx, hypervisor, console, name):
 
 
 @vms.command("stop")
-@click.argument("name")
+@click.option("--parallel", default=8, help="Number of machines to stop at the same time")
+@click.argument("names", nargs=-1, required=True)
 @pass_hypervisor
-def vms_stop(hypervisor, name):
+@click.pass_context
+def vms_stop(ctx, hypervisor, parallel, names):
     """
-    Stop a virtual machine.
+    Stop one or more virtual machines.
+
+    Names can be glob patterns, for example `web-*`.
     """
-    vm = hypervisor.vms.get(name)
-    vm.stop()
-    click.echo(f"Vm {name} stopped")
+    run_vms(ctx, hypervisor, names, Vm.stop, "stopped", parallel)
 
 
 @vms.command("monitor")
@@ -367,7 +438,17 @@ def images_list(hypervisor, details):
     """
     List all available images.
     """
-    for image in hypervisor.images.all():
+    for image in hypervisor.images.all(info=details):
+        if not details:
+            click.echo("\t".join([
+                image.name.ljust(40),
+                sizeof_fmt(image.size).rjust(8),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(image.mtime)),
+            ]))
+            continue
+        if not image.spec:
+            click.echo("\t".join([image.name.ljust(40), "-".rjust(8), "-".rjust(8)]))
+            continue
         click.echo("\t".join([
             image.name.ljust(40),
             sizeof_fmt(image.spec["actual-size"]).rjust(8),
@@ -375,6 +456,28 @@ def images_list(hypervisor, details):
         ]))
 
 
+@images.command("import")
+@click.option("--format", default=None, help="Convert the image to this format, for example qcow2")
+@click.option("--member", default=None, help="File to extract from a tarball or vagrant box")
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.argument("name")
+@pass_hypervisor
+def images_import(hypervisor, format, member, source, name):
+    """
+    Import a local image, tarball or vagrant box.
+
+    \b
+    Examples:
+    \b
+        qemuctl images import Fedora-Cloud-Base-39.qcow2 fedora/39.qcow2
+        qemuctl images import debian-12.raw.xz debian/12.qcow2 --format qcow2
+        qemuctl images import libvirt.box alpine/317.qcow2 --member box.img
+    """
+    with click.progressbar(length=os.path.getsize(source), label=f"Importing {name}") as bar:
+        image = hypervisor.images.create(name, source, format=format, member=member, progress=lambda position, total: bar.update(position - bar.pos))
+    click.echo(f"Image {image.name} imported")
+
+
 @images.command("show")
 @click.argument("name")
 @pass_hypervisor
@@ -386,6 +489,60 @@ def images_show(hypervisor, name):
     click.echo(json.dumps(image.spec, indent=2))
 
 
+@images.command("verify")
+@click.argument("name")
+@pass_hypervisor
+@click.pass_context
+def images_verify(ctx, hypervisor, name):
+    """
+    Verify the content of an image against its digest.
+    """
+    image = hypervisor.images.get(name)
+    if not image.verify():
+        ctx.fail(f"Image {name} is corrupt")
+    click.echo(f"Image {name} is ok")
+
+
+@images.command("rename")
+@click.argument("name")
+@click.argument("new_name")
+@pass_hypervisor
+def images_rename(hypervisor, name, new_name):
+    """
+    Rename an image.
+    """
+    image = hypervisor.images.get(name).rename(new_name)
+    click.echo(f"Image {name} renamed to {image.name}")
+
+
+@images.command("dedup")
+@pass_hypervisor
+def images_dedup(hypervisor):
+    """
+    Move all images into the content addressed blob store.
+
+    Images with identical content end up sharing a single blob.
+    """
+    for image in hypervisor.images.dedup():
+        click.echo(f"Image {image.name} stored")
+
+
+@images.command("gc")
+@click.option("--dry-run", is_flag=True, help="Only show what would be removed")
+@click.argument("patterns", nargs=-1)
+@pass_hypervisor
+def images_gc(hypervisor, dry_run, patterns):
+    """
+    Remove images that are not used by any virtual machine.
+
+    Only images matching PATTERNS are considered, by default the templates
+    left behind by vms clone. Use '*' to consider every image. Blobs that
+    are no longer linked to are always removed.
+    """
+    for path in hypervisor.images.gc(patterns or ("templates/*",), dry_run):
+        click.echo(f"{'Would remove' if dry_run else 'Removed'} {path}")
+
+
 @images.command("delete")
 @click.argument("name")
 @pass_hypervisor
@@ -474,8 +631,7 @@ def networks_restart(hypervisor, name):
     """
     network = hypervisor.networks.get(name)
     network.stop()
-    time.sleep(1)
-    network.start()
+    network.start().wait_ready()
     click.echo(f"Network {name} restarted")
 
 
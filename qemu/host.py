@@ -0,0 +1,273 @@
+"""
+Helpers that run on the hypervisor host.
+
+This module only depends on the standard library so its source can be shipped
+to a remote hypervisor and executed there with `python3 -c`, turning many
+small remote operations into a single round trip.
+
+Started with `serve` it stays resident and answers newline delimited JSON-RPC
+requests on stdin, so a whole session can share one channel.
+"""
+import base64
+import itertools
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_json(filename):
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def mtime(filename):
+    try:
+        return int(os.path.getmtime(filename))
+    except OSError:
+        return None
+
+
+def size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+
+def process_running(pidfile, name=None):
+    try:
+        with open(pidfile) as file:
+            pid = int(file.read().strip())
+        with open(f"/proc/{pid}/comm") as file:
+            comm = file.read().strip()
+    except (OSError, ValueError):
+        return False
+    return name is None or name in comm
+
+
+def process_kill(pidfile, name=None):
+    if not process_running(pidfile, name):
+        return False
+    with open(pidfile) as file:
+        os.kill(int(file.read().strip()), signal.SIGTERM)
+    return True
+
+
+def poll(check, timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while not check():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return True
+
+
+def wait_file(filename, timeout=30):
+    return poll(lambda: os.path.exists(filename), timeout)
+
+
+def wait_process(pidfile, name=None, running=True, timeout=30):
+    return poll(lambda: process_running(pidfile, name) == running, timeout)
+
+
+def inventory(directory, name=None):
+    if not os.path.isdir(directory):
+        return []
+    result = []
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        if not os.path.isdir(path):
+            continue
+        result.append({
+            "name": entry,
+            "running": process_running(os.path.join(path, "pidfile"), name),
+            "spec": read_json(os.path.join(path, "spec.json")),
+        })
+    return result
+
+
+def leases(directory, mtimes):
+    if not os.path.isdir(directory):
+        return {}
+    result = {}
+    for name in os.listdir(directory):
+        leases_file = os.path.join(directory, name, "leases")
+        modified = mtime(leases_file)
+        if modified is None:
+            continue
+        result[name] = {"mtime": modified}
+        if mtimes.get(name) != modified:
+            with open(leases_file) as file:
+                result[name]["leases"] = file.read().splitlines()
+    return result
+
+
+def image_info(files, cache_file):
+    cache = read_json(cache_file) or {}
+    result = {}
+    stale = {}
+    for file in files:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            cache.pop(file, None)
+            continue
+        key = [stat.st_size, stat.st_mtime_ns]
+        if file in cache and cache[file]["key"] == key:
+            result[file] = cache[file]["info"]
+        else:
+            stale[file] = key
+    if not stale:
+        return result
+
+    def qemu_img_info(file):
+        returncode, stdout, stderr = run(["qemu-img", "info", "--force-share", "--output=json", file])
+        return json.loads(stdout) if returncode == 0 else None
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for file, info in zip(stale, executor.map(qemu_img_info, stale)):
+            cache[file] = {"key": stale[file], "info": info}
+            result[file] = info
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(f"{cache_file}.tmp", "w") as file:
+        json.dump(cache, file)
+    os.replace(f"{cache_file}.tmp", cache_file)
+    return result
+
+
+def run(command, cwd=None):
+    result = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.returncode, result.stdout.decode(), result.stderr.decode()
+
+
+def read_file(filename):
+    with open(filename) as file:
+        return file.read()
+
+
+def write_file(filename, data):
+    with open(filename, "w") as file:
+        file.write(data)
+
+
+def scan(directory):
+    try:
+        entries = os.scandir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                yield entry.path, stat.st_size, int(stat.st_mtime), "l" if entry.is_symlink() else "f"
+
+
+def walk(directory):
+    return list(scan(directory))
+
+
+SOCKETS = {}
+SOCKET_IDS = itertools.count()
+
+
+def socket_open(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    handle = next(SOCKET_IDS)
+    SOCKETS[handle] = sock
+    return handle
+
+
+def socket_send(handle, data):
+    SOCKETS[handle].sendall(base64.b64decode(data))
+
+
+def socket_recv(handle, size):
+    return base64.b64encode(SOCKETS[handle].recv(size)).decode()
+
+
+def socket_wait(handle, timeout=None):
+    return bool(select.select([SOCKETS[handle]], [], [], timeout)[0])
+
+
+def socket_close(handle):
+    sock = SOCKETS.pop(handle, None)
+    if sock:
+        sock.close()
+
+
+COMMANDS = {
+    "image_info": image_info,
+    "inventory": inventory,
+    "leases": leases,
+    "wait_file": wait_file,
+    "wait_process": wait_process,
+}
+
+AGENT_COMMANDS = dict(COMMANDS, **{
+    "run": run,
+    "read_file": read_file,
+    "write_file": write_file,
+    "walk": walk,
+    "list_dir": os.listdir,
+    "make_dir": os.makedirs,
+    "symlink": os.symlink,
+    "is_file": os.path.isfile,
+    "is_dir": os.path.isdir,
+    "mtime": mtime,
+    "size": size,
+    "realpath": os.path.realpath,
+    "remove_file": os.remove,
+    "remove_dir": shutil.rmtree,
+    "pid_exists": process_running,
+    "pid_kill": process_kill,
+    "socket_open": socket_open,
+    "socket_send": socket_send,
+    "socket_recv": socket_recv,
+    "socket_wait": socket_wait,
+    "socket_close": socket_close,
+})
+
+
+def serve(stdin, stdout):
+    lock = threading.Lock()
+
+    def handle(request):
+        try:
+            response = {"id": request["id"], "result": AGENT_COMMANDS[request["method"]](*request["params"])}
+        except Exception as error:
+            response = {"id": request["id"], "error": {"type": type(error).__name__, "message": str(error)}}
+        data = json.dumps(response).encode() + b"\n"
+        with lock:
+            stdout.write(data)
+            stdout.flush()
+
+    for line in stdin:
+        threading.Thread(target=handle, args=(json.loads(line),), daemon=True).start()
+
+
+def main(argv):
+    command, *args = argv
+    if command == "serve":
+        return serve(sys.stdin.buffer, sys.stdout.buffer)
+    json.dump(COMMANDS[command](*[json.loads(arg) for arg in args]), sys.stdout)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,19 +1,27 @@
+import collections
 import os
 import shutil
 import subprocess
 
+from . import host
+from .qmp import AsyncQmp
 from .qmp import Qmp
+from .qmp import QmpPool
 from .images import Images
 from .networks import Networks
 from .vms import Vms
 
 
+WalkEntry = collections.namedtuple("WalkEntry", ["path", "size", "mtime", "type"])
+
+
 class Hypervisor:
     def __init__(self, directory="", vnc_address="127.0.0.1", vnc_password=None):
         self.directory = os.path.abspath(directory)
         self.vms = Vms(self)
         self.images = Images(self)
         self.networks = Networks(self)
+        self.monitors = QmpPool(self.qmp)
         self.config = {
             'vnc': {
                 'address': vnc_address,
@@ -31,6 +39,9 @@ class Hypervisor:
             },
         }
 
+    def call(self, command, *args):
+        return host.COMMANDS[command](*args)
+
     def exec(self, command, check=True, cwd=None):
         return subprocess.run(command, text=True, capture_output=True, check=check, cwd=cwd).stdout
 
@@ -64,6 +75,21 @@ class Hypervisor:
     def is_dir(self, directory):
         return os.path.isdir(directory)
 
+    def mtime(self, filename):
+        try:
+            return int(os.path.getmtime(filename))
+        except FileNotFoundError:
+            return None
+
+    def realpath(self, filename):
+        return os.path.realpath(filename)
+
+    def size(self, filename):
+        try:
+            return os.path.getsize(filename)
+        except FileNotFoundError:
+            return None
+
     def remove_file(self, filename):
         return os.remove(filename)
 
@@ -71,11 +97,16 @@ class Hypervisor:
         return shutil.rmtree(directory)
 
     def walk(self, directory):
-        files = []
-        for root, dirs, files in os.walk(self.directory):
-            for file in files:
-                files.append(os.path.join(root, file))
-        return files
+        return (WalkEntry(*entry) for entry in host.scan(directory))
 
     def qmp(self, filename):
         return Qmp.from_local_socket(filename)
+
+    def async_qmp(self, filename):
+        return AsyncQmp.from_local_socket(filename)
+
+    def monitor(self, filename):
+        return self.monitors.session(filename)
+
+    def close(self):
+        self.monitors.close()
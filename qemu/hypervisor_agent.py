@@ -0,0 +1,173 @@
+import base64
+import builtins
+import inspect
+import io
+import itertools
+import json
+import logging
+import shlex
+import threading
+
+from . import host
+from .qmp import Qmp
+from .hypervisor import WalkEntry
+from .hypervisor_ssh import HypervisorSSH
+
+
+class AgentConnection:
+    def __init__(self, hypervisor, path):
+        self.hypervisor = hypervisor
+        self.path = path
+        self.handle = None
+
+    def is_open(self):
+        return self.handle is not None
+
+    def open(self):
+        if self.handle is None:
+            self.handle = self.hypervisor.request("socket_open", self.path)
+
+    def close(self):
+        if self.handle is not None:
+            self.hypervisor.request("socket_close", self.handle)
+            self.handle = None
+
+    def read(self, size):
+        return base64.b64decode(self.hypervisor.request("socket_recv", self.handle, size))
+
+    def wait(self, timeout=None):
+        return self.hypervisor.request("socket_wait", self.handle, timeout)
+
+    def write(self, data):
+        self.hypervisor.request("socket_send", self.handle, base64.b64encode(data.encode()).decode())
+
+
+class AgentFile(io.StringIO):
+    def __init__(self, hypervisor, filename):
+        super().__init__()
+        self.hypervisor = hypervisor
+        self.filename = filename
+
+    def close(self):
+        if not self.closed:
+            self.hypervisor.request("write_file", self.filename, self.getvalue())
+        super().close()
+
+
+class HypervisorAgent(HypervisorSSH):
+    """
+    Runs a resident `qemu.host` helper on the hypervisor and sends every
+    operation to it as a JSON-RPC request over a single ssh channel.
+
+    Requests are pipelined: callers from several threads can have requests
+    in flight at once and responses are routed back by id.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._agent = None
+        self._ids = itertools.count()
+        self._responses = {}
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def spawn_agent(self):
+        logging.info(f"Starting agent on {self._host.hostname}")
+        channel = self.connection(0).get_transport().open_session()
+        channel.exec_command(shlex.join(["python3", "-c", inspect.getsource(host), "serve"]))
+        return channel.makefile("wb"), channel.makefile("rb")
+
+    @property
+    def agent(self):
+        with self._lock:
+            if not self._agent:
+                self._agent = self.spawn_agent()
+        return self._agent
+
+    def request(self, method, *params):
+        stdin, stdout = self.agent
+        id = next(self._ids)
+        logging.debug(f"==> {method} {params}")
+        with self._write_lock:
+            stdin.write(json.dumps({"id": id, "method": method, "params": params}).encode() + b"\n")
+            stdin.flush()
+        with self._read_lock:
+            while id not in self._responses:
+                line = stdout.readline()
+                if not line:
+                    raise ConnectionError("Agent closed the connection")
+                response = json.loads(line)
+                self._responses[response["id"]] = response
+            response = self._responses.pop(id)
+        if "error" in response:
+            error = getattr(builtins, response["error"]["type"], Exception)
+            if not (isinstance(error, type) and issubclass(error, Exception)):
+                error = Exception
+            raise error(response["error"]["message"])
+        return response["result"]
+
+    def call(self, command, *args):
+        return self.request(command, *args)
+
+    def exec(self, command, check=True, cwd=None):
+        logging.debug("==> " + ' '.join(command))
+        resultcode, stdout, stderr = self.request("run", command, cwd or self.directory)
+        if check and resultcode > 0:
+            raise Exception(stderr)
+        return stdout
+
+    def pid_kill(self, pidfile, name=None):
+        return self.request("pid_kill", pidfile, name)
+
+    def pid_exists(self, pidfile, name=None):
+        return self.request("pid_exists", pidfile, name)
+
+    def open_file(self, filename, mode="r", *args):
+        if "b" in mode:
+            return super().open_file(filename, mode, *args)
+        if "r" in mode:
+            return io.StringIO(self.request("read_file", filename))
+        return AgentFile(self, filename)
+
+    def symlink(self, source, destination):
+        return self.request("symlink", source, destination)
+
+    def list_dir(self, directory):
+        return self.request("list_dir", directory)
+
+    def make_dir(self, directory):
+        return self.request("make_dir", directory)
+
+    def is_file(self, filename):
+        return self.request("is_file", filename)
+
+    def is_dir(self, directory):
+        return self.request("is_dir", directory)
+
+    def mtime(self, filename):
+        return self.request("mtime", filename)
+
+    def realpath(self, filename):
+        return self.request("realpath", filename)
+
+    def size(self, filename):
+        return self.request("size", filename)
+
+    def remove_file(self, filename):
+        return self.request("remove_file", filename)
+
+    def remove_dir(self, directory):
+        return self.request("remove_dir", directory)
+
+    def walk(self, directory):
+        return [WalkEntry(*entry) for entry in self.request("walk", directory)]
+
+    def qmp(self, filename):
+        return Qmp(AgentConnection(self, filename))
+
+    def close(self):
+        self.monitors.close()
+        if self._agent:
+            for file in self._agent:
+                file.close()
+            self._agent = None
+        super().close()
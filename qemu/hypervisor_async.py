@@ -0,0 +1,46 @@
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncHypervisor:
+    """
+    Exposes the primitives of a Hypervisor as coroutines.
+
+    The blocking primitives run on a bounded thread pool so that many of
+    them can be in flight at once, monitors are AsyncQmp clients.
+
+        async with AsyncHypervisor(hypervisor, concurrency=32) as ahv:
+            await asyncio.gather(*[ahv.exec(["true"]) for _ in range(64)])
+    """
+    def __init__(self, hypervisor, concurrency=16, timeout=None):
+        self.hypervisor = hypervisor
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self.hypervisor, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return method
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def qmp(self, filename):
+        return await self.run(self.hypervisor.async_qmp, filename)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
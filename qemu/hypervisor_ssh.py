@@ -1,62 +1,108 @@
+import contextlib
+import inspect
+import itertools
+import json
 import logging
 import os
 import paramiko
 import shlex
+import threading
 
 from stat import S_ISDIR
 from stat import S_ISREG
 from urllib.parse import urlparse
 
+from . import host
+from .qmp import AsyncQmp
 from .qmp import Qmp
 from .hypervisor import Hypervisor
+from .hypervisor import WalkEntry
 
 
 class HypervisorSSH(Hypervisor):
-    def __init__(self, host, vnc_address="127.0.0.1", vnc_password=None):
+    """
+    Runs everything on a remote hypervisor over ssh.
+
+    Commands can be executed from several threads at once. They are spread
+    over `connections` transports and each transport runs at most
+    `max_sessions` channels at the same time so we stay below the
+    MaxSessions limit of the ssh server. Monitor channels count against
+    the same limit and at most half of them are kept open by the pool.
+    """
+    def __init__(self, host, vnc_address="127.0.0.1", vnc_password=None, max_sessions=8, connections=1):
         self._host = urlparse(host)
         if self._host.scheme != 'ssh':
             raise Exception()
-        self._client = None
+        self._clients = [None] * connections
+        self._semaphores = [threading.BoundedSemaphore(max_sessions) for _ in range(connections)]
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
         self._sftp = None
         super().__init__(self._host.path, vnc_address, vnc_password)
+        self.monitors.max_size = max(1, max_sessions // 2)
 
     @property
     def client(self):
-        if not self._client:
-            logging.info(f"Connecting to {self._host.hostname}")
-            self._client = paramiko.SSHClient()
-            self._client.load_system_host_keys()
-            self._client.connect(self._host.hostname, username=self._host.username, password=self._host.password)
-        return self._client
+        return self.connection(0)
 
     @property
     def sftp(self):
-        if not self._sftp:
-            self._sftp = self.client.open_sftp()
+        with self._lock:
+            if not self._sftp:
+                self._sftp = self.connection(0).open_sftp()
         return self._sftp
 
+    def connection(self, index):
+        with self._lock:
+            if not self._clients[index]:
+                logging.info(f"Connecting to {self._host.hostname}")
+                client = paramiko.SSHClient()
+                client.load_system_host_keys()
+                client.connect(self._host.hostname, username=self._host.username, password=self._host.password)
+                self._clients[index] = client
+            return self._clients[index]
+
+    @contextlib.contextmanager
+    def session(self):
+        index = next(self._counter) % len(self._clients)
+        transport = self.connection(index).get_transport()
+        with self._semaphores[index]:
+            channel = transport.open_session()
+            try:
+                yield channel
+            finally:
+                channel.close()
+
+    def _run(self, command):
+        with self.session() as channel:
+            channel.exec_command(command)
+            stdout = channel.makefile("rb").read()
+            stderr = channel.makefile_stderr("rb").read()
+            return channel.recv_exit_status(), stdout.decode(), stderr.decode()
+
+    def call(self, command, *args):
+        source = inspect.getsource(host)
+        return json.loads(self.exec(["python3", "-c", source, command] + [json.dumps(arg) for arg in args]))
+
     def exec(self, command, check=True, cwd=None):
         logging.debug("==> " + ' '.join(command))
         cwd = cwd or self.directory
-        stdin, stdout, stderr = self.client.exec_command(f"cd {cwd}; " + shlex.join(command))
-        resultcode = stdout.channel.recv_exit_status()
+        resultcode, stdout, stderr = self._run(f"cd {cwd}; " + shlex.join(command))
         if check and resultcode > 0:
-            raise Exception(stderr.read().decode())
-        return stdout.read().decode()
+            raise Exception(stderr)
+        return stdout
 
     def pid_kill(self, pidfile, name=None):
         args = ["pkill", "--pidfile", pidfile]
         if name:
             args += [name]
-        stdin, stdout, stderr = self.client.exec_command(shlex.join(args))
-        return stdout.channel.recv_exit_status() == 0
+        return self._run(shlex.join(args))[0] == 0
 
     def pid_exists(self, pidfile, name=None):
         args = ["pgrep", "--pidfile", pidfile]
         if name:
             args += [name]
-        stdin, stdout, stderr = self.client.exec_command(shlex.join(args))
-        return stdout.channel.recv_exit_status() == 0
+        return self._run(shlex.join(args))[0] == 0
 
     def open_file(self, filename, *args):
         return self.sftp.file(filename, *args)
@@ -85,18 +131,65 @@ class HypervisorSSH(Hypervisor):
         except FileNotFoundError:
             return False
 
+    def mtime(self, filename):
+        try:
+            return self.sftp.stat(filename).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def realpath(self, filename):
+        return self.sftp.normalize(filename)
+
+    def size(self, filename):
+        try:
+            return self.sftp.stat(filename).st_size
+        except FileNotFoundError:
+            return None
+
     def remove_file(self, filename):
         return self.sftp.remove(filename)
 
     def remove_dir(self, directory):
         if not self.is_dir(directory):
             raise Exception(f"{directory} is not a directory")
-        self.client.exec_command(f"rm -rf {shlex.quote(directory)}")
+        self.exec(["rm", "-rf", directory])
 
     def walk(self, directory):
-        return self.exec(["find", directory, "-type", "f"]).split()
+        output = self.exec([
+            "find", "-L", directory, "-type", "f",
+            "(", "-xtype", "l", "-printf", "%p\\0%s\\0%T@\\0l\\0", "-o", "-printf", "%p\\0%s\\0%T@\\0f\\0", ")",
+        ])
+        fields = output.split("\0")
+        for index in range(0, len(fields) - 1, 4):
+            path, size, mtime, type = fields[index:index + 4]
+            yield WalkEntry(path, int(size), int(float(mtime)), type)
+
+    def _open_channel(self, command):
+        index = next(self._counter) % len(self._clients)
+        transport = self.connection(index).get_transport()
+        self._semaphores[index].acquire()
+        try:
+            channel = transport.open_session()
+            channel.exec_command(command)
+        except Exception:
+            self._semaphores[index].release()
+            raise
+        return channel, self._semaphores[index].release
 
     def qmp(self, filename):
-        channel = self.client.get_transport().open_session()
-        channel.exec_command(f"socat - UNIX-CONNECT:{filename}")
-        return Qmp.from_ssh_channel(channel)
+        channel, release = self._open_channel(f"socat - UNIX-CONNECT:{filename}")
+        return Qmp.from_ssh_channel(channel, release)
+
+    def async_qmp(self, filename):
+        channel, release = self._open_channel(f"socat - UNIX-CONNECT:{filename}")
+        return AsyncQmp.from_ssh_channel(channel, release=release)
+
+    def close(self):
+        super().close()
+        if self._sftp:
+            self._sftp.close()
+            self._sftp = None
+        for index, client in enumerate(self._clients):
+            if client:
+                client.close()
+                self._clients[index] = None
@@ -1,5 +1,25 @@
+import bz2
+import fnmatch
+import gzip
+import hashlib
 import json
+import lzma
 import os
+import shlex
+import tarfile
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+IMAGE_EXTENSIONS = (".img", ".qcow2", ".raw")
+
+ARCHIVE_EXTENSIONS = (".box", ".tar", ".tar.gz", ".tgz", ".tar.xz", ".tar.bz2")
+
+COMPRESSED_EXTENSIONS = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+    ".bz2": bz2.open,
+}
 
 
 class Image:
@@ -7,43 +27,251 @@ class Image:
         self.hypervisor = hypervisor
         self.name = name
         self.file = os.path.join(self.hypervisor.images.directory, self.name)
+        self.size = None
+        self.mtime = None
+        self._spec = None
 
     def __repr__(self):
         return f"<Image {self.name}>"
 
     @property
     def spec(self):
-        return json.loads(self.hypervisor.exec(["qemu-img", "info", "--force-share", "--output=json", self.file]))
+        if self._spec is None:
+            self._spec = json.loads(self.hypervisor.exec(["qemu-img", "info", "--force-share", "--output=json", self.file]))
+        return self._spec
+
+    @property
+    def blob(self):
+        path = self.hypervisor.realpath(self.file)
+        return path if os.path.dirname(path) == self.hypervisor.images.blobs else None
+
+    def verify(self):
+        blob = self.blob
+        if not blob:
+            raise Exception(f"Image {self.name} is not content addressed")
+        return self.hypervisor.exec(["sha256sum", blob]).split()[0] == os.path.basename(blob)
+
+    def rename(self, name):
+        destination = os.path.join(self.hypervisor.images.directory, name)
+        if self.hypervisor.is_file(destination):
+            raise Exception(f"Image {name} already exists")
+        self.hypervisor.exec(["mkdir", "-p", os.path.dirname(destination)])
+        self.hypervisor.exec(["mv", "--no-target-directory", self.file, destination])
+        return Image(self.hypervisor, name)
 
     def delete(self):
+        vms = self.hypervisor.images.references().get(self.name)
+        if vms:
+            raise Exception(f"Image {self.name} is used by {', '.join(sorted(vms))}")
+        blob = self.blob
         self.hypervisor.remove_file(self.file)
+        if blob and not self.hypervisor.exec(["find", self.hypervisor.images.directory, self.hypervisor.vms.directory, "-lname", blob], check=False):
+            self.hypervisor.remove_file(blob)
 
 
 class Images:
     def __init__(self, hypervisor):
         self.hypervisor = hypervisor
         self.directory = os.path.join(hypervisor.directory, "images")
+        self.blobs = os.path.join(hypervisor.directory, "blobs", "sha256")
+        self.uploads = os.path.join(hypervisor.directory, "cache", "uploads")
+        self.cache_file = os.path.join(hypervisor.directory, "cache", "images.json")
+        self._references = None
 
-    def all(self):
+    def all(self, info=False):
         if not self.hypervisor.is_dir(self.directory):
             return []
         images = []
-        for file in self.hypervisor.walk(self.directory):
-            name = os.path.relpath(file, start=self.directory)
-            images.append(Image(self.hypervisor, name))
+        for entry in self.hypervisor.walk(self.directory):
+            image = Image(self.hypervisor, os.path.relpath(entry.path, start=self.directory))
+            image.size, image.mtime = entry.size, entry.mtime
+            images.append(image)
+        if info:
+            self.load_info(images)
         return images
 
+    def load_info(self, images):
+        infos = self.hypervisor.call("image_info", [image.file for image in images], self.cache_file)
+        for image in images:
+            image._spec = infos.get(image.file) or {}
+
     def get(self, name):
         if not self.hypervisor.is_file(os.path.join(self.directory, name)):
             raise Exception(f"Image {name} does not exist")
         return Image(self.hypervisor, name)
 
-    def create(self, spec):  # TODO: add download functionality here
+    def references(self):
+        """
+        Map every image used as a backing file or cdrom to the names of the
+        vms using it. Built from one inventory scan and kept up to date as
+        vms are created and destroyed.
+        """
+        if self._references is None:
+            self._references = {}
+            for vm, running, spec in self.hypervisor.vms.inventory():
+                if spec:
+                    self.reference(vm.name, spec)
+        return self._references
+
+    def reference(self, vm, spec):
+        if self._references is None:
+            return
+        for name in referenced_images(spec):
+            self._references.setdefault(name, set()).add(vm)
+
+    def unreference(self, vm):
+        if self._references is None:
+            return
+        for name in list(self._references):
+            self._references[name].discard(vm)
+            if not self._references[name]:
+                del self._references[name]
+
+    def gc(self, patterns=("templates/*",), dry_run=False):
+        """
+        Delete images matching `patterns` that no vm uses and blobs that
+        neither an image nor a vm links to. Returns what was (or with
+        `dry_run` would be) removed.
+        """
+        references = self.references()
+        removed = []
+        for image in self.all():
+            if image.name in references or not any(fnmatch.fnmatch(image.name, pattern) for pattern in patterns):
+                continue
+            if not dry_run:
+                image.delete()
+            removed.append(image.name)
+        if not self.hypervisor.is_dir(self.blobs):
+            return removed
+        links = self.hypervisor.exec(["find", self.directory, self.hypervisor.vms.directory, "-type", "l", "-printf", "%l\\0"], check=False)
+        links = set(links.split("\0"))
+        for digest in sorted(self.hypervisor.list_dir(self.blobs)):
+            blob = os.path.join(self.blobs, digest)
+            if blob in links:
+                continue
+            if not dry_run:
+                self.hypervisor.remove_file(blob)
+            removed.append(blob)
+        return removed
+
+    def store(self, name, file=None, digest=None):
         """
-        get json https://app.vagrantup.com/generic/boxes/rocky9
-        find most recent version number
-        check if we have the version already
-        wget --output-document=- https://app.vagrantup.com/generic/boxes/alpine317/versions/4.2.16/providers/libvirt.box | tar --extract --file=- box.img
-        tar --extract --file libvirt.box --transform 's#box.img#fuu.img#' box.img
+        Move `file` (by default the image itself) into the blob store under
+        its sha256 digest and point the image name at the blob. When a blob
+        with the same content already exists the file is dropped instead.
         """
-        pass
+        link = os.path.join(self.directory, name)
+        file = file or link
+        digest = shlex.quote(digest) if digest else f"$(sha256sum {shlex.quote(file)} | cut -d ' ' -f 1)"
+        script = "\n".join([
+            "set -e",
+            f"digest={digest}",
+            f"blob={shlex.quote(self.blobs)}/$digest",
+            f"mkdir -p {shlex.quote(self.blobs)} {shlex.quote(os.path.dirname(link))}",
+            f'if [ -e "$blob" ]; then rm -f {shlex.quote(file)}; else mv {shlex.quote(file)} "$blob"; chmod a-w "$blob"; fi',
+            f'ln -sfn "$blob" {shlex.quote(link)}',
+            'echo "$blob"',
+        ]) + "\n"
+        return self.hypervisor.exec(["sh", "-c", script]).strip()
+
+    def dedup(self):
+        stored = []
+        for image in self.all():
+            if not image.blob:
+                self.store(image.name)
+                stored.append(image)
+        return stored
+
+    def _read_marker(self, marker):
+        if not self.hypervisor.is_file(marker):
+            return None
+        with self.hypervisor.open_file(marker, "r") as file:
+            return json.load(file)
+
+    def create(self, name, source, format=None, member=None, progress=None):
+        """
+        Import a local image file into the image library.
+
+        The source is streamed through decompression (gz, xz, bz2) and tar
+        extraction (tarballs and vagrant boxes, the first .img/.qcow2/.raw
+        member unless `member` is given) straight into the upload on the
+        hypervisor; nothing is staged locally. An interrupted upload is
+        resumed from where it stopped, provided it was started from the same
+        source. With `format` the upload is converted
+        with `qemu-img convert` on the hypervisor. The result is stored in the
+        blob store by its sha256 digest, computed while streaming.
+        """
+        file = os.path.join(self.directory, name)
+        if self.hypervisor.is_file(file):
+            raise Exception(f"Image {name} already exists")
+        upload = os.path.join(self.uploads, f"{name}.part")
+        for directory in [os.path.dirname(file), os.path.dirname(upload)]:
+            if not self.hypervisor.is_dir(directory):
+                self.hypervisor.make_dir(directory)
+        marker = f"{upload}.json"
+        identity = source_identity(source, member)
+        offset = self.hypervisor.size(upload) or 0
+        if offset and self._read_marker(marker) != identity:
+            offset = 0
+        with self.hypervisor.open_file(marker, "w") as file:
+            json.dump(identity, file)
+        total = identity["size"]
+        digest = hashlib.sha256()
+        raw, stream = open_source(source, member)
+        with raw:
+            skip(stream, offset, digest)
+            with self.hypervisor.open_file(upload, "ab" if offset else "wb") as remote:
+                if hasattr(remote, "set_pipelined"):
+                    remote.set_pipelined(True)
+                while True:
+                    data = stream.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    remote.write(data)
+                    if progress:
+                        progress(raw.tell(), total)
+        self.hypervisor.remove_file(marker)
+        if format:
+            self.hypervisor.exec(["qemu-img", "convert", "-O", format, upload, f"{upload}.{format}"])
+            self.hypervisor.remove_file(upload)
+            self.store(name, f"{upload}.{format}")
+        else:
+            self.store(name, upload, digest.hexdigest())
+        return Image(self.hypervisor, name)
+
+
+def referenced_images(spec):
+    names = {drive["backing_file"] for drive in spec.get("drives", []) if drive.get("backing_file")}
+    if spec.get("cdrom"):
+        names.add(spec["cdrom"])
+    return names
+
+
+def source_identity(source, member=None):
+    stat = os.stat(source)
+    return {"source": os.path.abspath(source), "member": member, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def open_source(source, member=None):
+    raw = open(source, "rb")
+    if source.endswith(ARCHIVE_EXTENSIONS):
+        archive = tarfile.open(fileobj=raw, mode="r|*")
+        for info in archive:
+            if info.isfile() and (info.name == member if member else info.name.endswith(IMAGE_EXTENSIONS)):
+                return raw, archive.extractfile(info)
+        raw.close()
+        raise Exception(f"No image found in {source}")
+    extension = os.path.splitext(source)[1]
+    if extension in COMPRESSED_EXTENSIONS:
+        return raw, COMPRESSED_EXTENSIONS[extension](raw)
+    return raw, raw
+
+
+def skip(stream, size, digest):
+    while size > 0:
+        data = stream.read(min(size, CHUNK_SIZE))
+        if not data:
+            raise Exception("Source is smaller than the partial upload")
+        digest.update(data)
+        size -= len(data)
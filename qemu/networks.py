@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 
 from .specs import NetworkSpec
 
@@ -9,8 +10,7 @@ class Network:
     def create_from_spec(hypervisor, spec):
         network = Network(hypervisor, spec["name"])
         network.hypervisor.make_dir(network.directory)
-        with network.hypervisor.open_file(os.path.join(network.directory, "spec.json"), "w") as file:
-            json.dump(spec, file)
+        network.save_spec(spec)
         if spec["dhcp"] or spec['tftp'] or spec['dns']:
             with network.hypervisor.open_file(os.path.join(network.directory, "dnsmasq.conf"), "w") as file:
                 file.write(generate_dnsmasq_config(spec, network.directory))
@@ -20,15 +20,23 @@ class Network:
         self.hypervisor = hypervisor
         self.name = name
         self.directory = os.path.join(self.hypervisor.networks.directory, self.name)
+        self._spec = None
 
     def __repr__(self):
         return f"<Network {self.name}>"
 
     @property
     def spec(self):
-        with self.hypervisor.open_file(os.path.join(self.directory, "spec.json"), "r") as file:
-            data = json.load(file)
-        return NetworkSpec(data)
+        if self._spec is None:
+            with self.hypervisor.open_file(os.path.join(self.directory, "spec.json"), "r") as file:
+                self._spec = NetworkSpec(json.load(file))
+        return self._spec
+
+    def save_spec(self, spec):
+        filename = os.path.join(self.directory, "spec.json")
+        with self.hypervisor.open_file(filename, "w") as file:
+            json.dump(spec, file)
+        self._spec = NetworkSpec(spec)
 
     @property
     def is_running(self):
@@ -64,17 +72,14 @@ class Network:
             return []
         with self.hypervisor.open_file(leases_file, "r") as file:
             raw_leases = file.readlines()
-        leases = []
-        for lease in raw_leases:
-            lease = lease.strip().split(" ")
-            leases.append({
-                "timestamp": lease[0],
-                "mac": lease[1],
-                "ip": lease[2],
-                "host": lease[3],
-                "id": lease[4],
-            })
-        return leases
+        return [parse_lease(lease) for lease in raw_leases if lease.strip()]
+
+    def wait_ready(self, timeout=10):
+        spec = self.spec
+        if spec["dhcp"] or spec['tftp'] or spec['dns']:
+            if not self.hypervisor.call("wait_process", os.path.join(self.directory, "pidfile"), "dnsmasq", True, timeout):
+                raise TimeoutError(f"Network {self.name} did not start dnsmasq within {timeout} seconds")
+        return self
 
     def start(self):
         bridge_address = self.address
@@ -96,8 +101,9 @@ class Network:
 
     def stop(self):
         spec = self.spec
-        if spec['dhcp']:
-            self.hypervisor.pid_kill(os.path.join(self.directory, "pidfile"), "dnsmasq")
+        if spec['dhcp'] and self.hypervisor.pid_kill(os.path.join(self.directory, "pidfile"), "dnsmasq"):
+            if not self.hypervisor.call("wait_process", os.path.join(self.directory, "pidfile"), "dnsmasq", False, 10):
+                raise TimeoutError(f"Network {self.name} did not stop dnsmasq within 10 seconds")
         if spec["ip_range"]:
             self.hypervisor.exec(["iptables", "-t", "nat", "-D", "POSTROUTING", "-s", f"{spec.ip_range[0]}/{spec.ip_range.prefixlen}", "-j", "MASQUERADE"])
         return self
@@ -106,12 +112,17 @@ class Network:
         self.stop()
         self.hypervisor.exec(["ip", "link", "delete", self.name], check=False)
         self.hypervisor.remove_dir(self.directory)
+        self.hypervisor.networks.cache.pop(self.name, None)
 
 
 class Networks:
     def __init__(self, hypervisor):
         self.hypervisor = hypervisor
         self.directory = os.path.join(hypervisor.directory, "networks")
+        self.lock = threading.Lock()
+        self.cache = {}
+        self._lease_files = {}
+        self._lease_index = None
 
     def __contains__(self, value):
         return self.hypervisor.is_dir(os.path.join(self.directory, value))
@@ -119,17 +130,54 @@ class Networks:
     def all(self):
         if not self.hypervisor.is_dir(self.directory):
             return []
-        return [Network(self.hypervisor, name) for name in self.hypervisor.list_dir(self.directory)]
+        return [self.network(name) for name in self.hypervisor.list_dir(self.directory)]
 
     def get(self, name):
         if name not in self:
             raise Exception(f"Network {name} does not exist")
-        return Network(self.hypervisor, name)
+        return self.network(name)
+
+    def network(self, name):
+        if name not in self.cache:
+            self.cache[name] = Network(self.hypervisor, name)
+        return self.cache[name]
+
+    def lease_index(self, refresh=False):
+        if self._lease_index is not None and not refresh:
+            return self._lease_index
+        mtimes = {name: entry["mtime"] for name, entry in self._lease_files.items()}
+        lease_files = {}
+        for name, entry in self.hypervisor.call("leases", self.directory, mtimes).items():
+            if "leases" in entry:
+                entry["leases"] = [parse_lease(lease) for lease in entry["leases"] if lease.strip()]
+            else:
+                entry["leases"] = self._lease_files[name]["leases"]
+            lease_files[name] = entry
+        index = {}
+        for name, entry in lease_files.items():
+            for lease in entry["leases"]:
+                index.setdefault(lease["mac"], []).append((lease["ip"], name, int(lease["timestamp"])))
+        for leases in index.values():
+            leases.sort(key=lambda lease: lease[2], reverse=True)
+        self._lease_files, self._lease_index = lease_files, index
+        return index
 
     def create(self, spec):
         if spec["name"] in self:
             raise Exception("Network already exists")
-        return Network.create_from_spec(self.hypervisor, spec)
+        network = self.cache[spec["name"]] = Network.create_from_spec(self.hypervisor, spec)
+        return network
+
+
+def parse_lease(line):
+    lease = line.strip().split(" ")
+    return {
+        "timestamp": lease[0],
+        "mac": lease[1],
+        "ip": lease[2],
+        "host": lease[3],
+        "id": lease[4],
+    }
 
 
 def generate_dnsmasq_config(spec, directory):
@@ -1,8 +1,13 @@
+import asyncio
 import binascii
+import contextlib
 import json
 import logging
 import os
+import select
 import socket
+import threading
+import time
 
 
 class SocketConnection:
@@ -26,13 +31,17 @@ class SocketConnection:
     def read(self, size):
         return os.read(self.socket.fileno(), size)
 
+    def wait(self, timeout=None):
+        return bool(select.select([self.socket], [], [], timeout)[0])
+
     def write(self, data):
-        os.write(self.socket.fileno(), data.encode())
+        self.socket.sendall(data.encode())
 
 
 class SSHConnection:
-    def __init__(self, channel):
+    def __init__(self, channel, release=None):
         self.channel = channel
+        self.release = release
 
     def is_open(self):
         return not self.channel.closed
@@ -42,12 +51,18 @@ class SSHConnection:
 
     def close(self):
         self.channel.close()
+        if self.release:
+            self.release()
+            self.release = None
 
     def read(self, size):
         return self.channel.recv(size)
 
+    def wait(self, timeout=None):
+        return bool(select.select([self.channel], [], [], timeout)[0])
+
     def write(self, data):
-        self.channel.send(data)
+        self.channel.sendall(data)
 
 
 class Qmp:
@@ -62,12 +77,17 @@ class Qmp:
         return cls(SocketConnection(path))
 
     @classmethod
-    def from_ssh_channel(cls, channel):
-        return cls(SSHConnection(channel))
+    def from_ssh_channel(cls, channel, release=None):
+        return cls(SSHConnection(channel, release))
 
     def __init__(self, conn):
-        self.events = []
+        self.backlog = []
+        self.responses = {}
+        self.buffer = bytearray()
+        self.offset = 0
         self.conn = conn
+        self.read_lock = threading.Lock()
+        self.write_lock = threading.Lock()
 
     def __enter__(self):
         self.open()
@@ -77,16 +97,27 @@ class Qmp:
         self.close()
 
     def open(self):
-        self.events = []
+        self.backlog = []
+        self.responses = {}
+        self.buffer.clear()
+        self.offset = 0
         self.conn.open()
-        if len(list(self._read())) == 0:
+        try:
+            greeting = self._read_message()
+        except ConnectionError:
+            greeting = {}
+        if "QMP" not in greeting:
+            self.conn.close()
             raise RuntimeError("Qmp monitor not available")
         self.execute("qmp_capabilities", enable=["oob"])
 
     def close(self):
         logging.debug(">>> EOF")
         self.conn.close()
-        self.events = []
+        self.backlog = []
+        self.responses = {}
+        self.buffer.clear()
+        self.offset = 0
 
     def execute(self, command, **kwargs):
         if not self.conn.is_open():
@@ -95,33 +126,286 @@ class Qmp:
         cmd = {"execute": command, "id": id}
         if kwargs:
             cmd["arguments"] = kwargs
-        self._write(cmd)
-        response = None
-        for message in self._read():
-            if "id" in message and message["id"] == id:
-                response = message
-            elif "event" in message:
-                self.events.append(message)
-            elif "error" in message:
-                response = message
-        if not response:
-            return None
+        with self.write_lock:
+            self._write(cmd)
+        with self.read_lock:
+            while id not in self.responses and None not in self.responses:
+                message = self._read_message()
+                if "event" in message:
+                    self.backlog.append(message)
+                else:
+                    self.responses[message.get("id")] = message
+            response = self.responses.pop(id, None) or self.responses.pop(None)
         if "error" in response:
             raise RuntimeError(response["error"]["desc"])
         return response["return"]
 
+    def events(self, timeout=None):
+        """
+        Yield events as the monitor sends them, starting with the ones that
+        arrived while executing commands. Stops when no event arrives within
+        `timeout` seconds or when the monitor goes away.
+        """
+        if not self.conn.is_open():
+            self.open()
+        while True:
+            while self.backlog:
+                yield self.backlog.pop(0)
+            with self.read_lock:
+                if self.buffer.find(b"\n", self.offset) < 0 and not self.conn.wait(timeout):
+                    return
+                try:
+                    message = self._read_message()
+                except ConnectionError:
+                    return
+                if "event" in message:
+                    self.backlog.append(message)
+                else:
+                    self.responses[message.get("id")] = message
+
     def _write(self, message):
         message = json.dumps(message) + "\n"
         logging.debug(f">>> {message}".strip())
         self.conn.write(message)
 
-    def _read(self):
-        response = b""
+    def _read_message(self):
+        scanned = self.offset
+        while True:
+            end = self.buffer.find(b"\n", scanned)
+            if end < 0:
+                if self.offset:
+                    del self.buffer[:self.offset]
+                    self.offset = 0
+                scanned = len(self.buffer)
+                data = self.conn.read(65536)
+                if not data:
+                    raise ConnectionError("Qmp monitor closed the connection")
+                self.buffer += data
+                continue
+            line = self.buffer[self.offset:end].decode().strip()
+            self.offset = scanned = end + 1
+            if self.offset == len(self.buffer):
+                self.buffer.clear()
+                self.offset = scanned = 0
+            if line:
+                logging.debug(f"<<< {line}")
+                return json.loads(line)
+
+
+class QmpPool:
+    """
+    Keeps one negotiated Qmp session per monitor socket so that consecutive
+    commands reuse the same channel instead of reconnecting every time.
+
+    At most `max_size` sessions are kept; the least recently used idle
+    session is closed to make room for a new one.
+    """
+    def __init__(self, factory, idle_timeout=60, check_interval=5, max_size=16):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.max_size = max_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self, path):
+        qmp = self.get(path)
+        try:
+            yield qmp
+        except OSError:
+            self.discard(path)
+            raise
+        finally:
+            qmp.users -= 1
+            qmp.last_used = time.monotonic()
+            self.evict()
+
+    def get(self, path):
+        with self.lock:
+            qmp = self.sessions.pop(path, None)
+            fresh = qmp is None
+            if fresh:
+                qmp = self.factory(path)
+                qmp.users = 0
+                qmp.last_used = time.monotonic()
+            self.sessions[path] = qmp
+            qmp.users += 1
+        self.evict()
+        if not fresh and qmp.conn.is_open() and time.monotonic() - qmp.last_used > self.check_interval:
+            try:
+                qmp.execute("query-version")
+            except OSError:
+                logging.info(f"Qmp session for {path} is stale, reconnecting")
+                qmp.users -= 1
+                self.discard(path)
+                return self.get(path)
+        if fresh or not qmp.conn.is_open():
+            try:
+                qmp.open()
+            except Exception:
+                qmp.users -= 1
+                self.discard(path)
+                raise
+        qmp.last_used = time.monotonic()
+        return qmp
+
+    def discard(self, path):
+        with self.lock:
+            qmp = self.sessions.pop(path, None)
+        if qmp:
+            qmp.close()
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [path for path, qmp in self.sessions.items() if not qmp.users]
+            excess = idle[:max(0, len(self.sessions) - self.max_size)]
+            expired = [path for path in idle if now - self.sessions[path].last_used > self.idle_timeout]
+            evicted = [self.sessions.pop(path) for path in dict.fromkeys(excess + expired)]
+        for qmp in evicted:
+            qmp.close()
+
+    def close(self):
+        for path in list(self.sessions):
+            self.discard(path)
+
+
+class AsyncQmp:
+    """
+    An asyncio flavour of Qmp. Responses are routed to the awaiting
+    `execute` call by id so many commands can be in flight on one monitor.
+    """
+    limit = 2 ** 24
+
+    @classmethod
+    def from_local_socket(cls, path, timeout=30):
+        return cls(lambda: asyncio.open_unix_connection(path, limit=cls.limit), timeout)
+
+    @classmethod
+    def from_ssh_channel(cls, channel, timeout=30, release=None):
+        async def connect():
+            local, remote = socket.socketpair()
+            threading.Thread(target=forward, args=(channel, remote, release), daemon=True).start()
+            return await asyncio.open_connection(sock=local, limit=cls.limit)
+        return cls(connect, timeout)
+
+    def __init__(self, connect, timeout=30):
+        self.connect = connect
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.dispatcher = None
+        self.pending = {}
+        self.events = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        self.events = asyncio.Queue()
+        self.reader, self.writer = await asyncio.wait_for(self.connect(), self.timeout)
+        try:
+            greeting = await asyncio.wait_for(self._read_message(), self.timeout)
+        except ConnectionError:
+            greeting = {}
+        if "QMP" not in greeting:
+            await self.close()
+            raise RuntimeError("Qmp monitor not available")
+        self.dispatcher = asyncio.ensure_future(self._dispatch())
+        await self.execute("qmp_capabilities", enable=["oob"])
+
+    async def close(self):
+        logging.debug(">>> EOF")
+        if self.dispatcher:
+            self.dispatcher.cancel()
+            self.dispatcher = None
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = self.writer = None
+
+    async def execute(self, command, **kwargs):
+        if not self.writer:
+            await self.open()
+        id = binascii.b2a_hex(os.urandom(4)).decode()
+        cmd = {"execute": command, "id": id}
+        if kwargs:
+            cmd["arguments"] = kwargs
+        self.pending[id] = asyncio.get_running_loop().create_future()
+        try:
+            message = json.dumps(cmd) + "\n"
+            logging.debug(f">>> {message}".strip())
+            self.writer.write(message.encode())
+            await self.writer.drain()
+            response = await asyncio.wait_for(self.pending[id], self.timeout)
+        finally:
+            self.pending.pop(id, None)
+        if "error" in response:
+            raise RuntimeError(response["error"]["desc"])
+        return response["return"]
+
+    async def listen(self, timeout=None):
+        while True:
+            try:
+                event = await asyncio.wait_for(self.events.get(), timeout)
+            except asyncio.TimeoutError:
+                return
+            if event is None:
+                return
+            yield event
+
+    async def _read_message(self):
         while True:
-            data = self.conn.read(1024)
-            response += data
-            if len(data) < 1024:
-                break
-        for message in response.decode().splitlines():
-            logging.debug(f"<<< {message}".strip())
-            yield json.loads(message)
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Qmp monitor closed the connection")
+            line = line.decode().strip()
+            if line:
+                logging.debug(f"<<< {line}")
+                return json.loads(line)
+
+    async def _dispatch(self):
+        try:
+            while True:
+                message = await self._read_message()
+                if "event" in message:
+                    self.events.put_nowait(message)
+                    continue
+                if "id" in message:
+                    future = self.pending.get(message["id"])
+                else:
+                    future = next(iter(self.pending.values()), None)
+                if future and not future.done():
+                    future.set_result(message)
+        except ConnectionError as error:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.events.put_nowait(None)
+
+
+def forward(channel, sock, release=None):
+    with sock:
+        while not channel.closed:
+            readable, _, _ = select.select([channel, sock], [], [])
+            if channel in readable:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                sock.sendall(data)
+            if sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                channel.sendall(data)
+    channel.close()
+    if release:
+        release()
@@ -1,9 +1,26 @@
+import fnmatch
 import json
+import logging
 import os
+import queue
+import shlex
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 
 from .specs import VmSpec
 
 
+STATE_EVENTS = {
+    "RESUME": "running",
+    "STOP": "paused",
+    "SHUTDOWN": "shutdown",
+}
+
+
 class Vm:
     @staticmethod
     def create_from_spec(hypervisor, spec):
@@ -20,41 +37,93 @@ class Vm:
                 "password": vm.hypervisor.config["vnc"]["password"],
             },
         })
-        with vm.hypervisor.open_file(os.path.join(vm.directory, "spec.json"), "w") as file:
-            json.dump(spec, file)
-        for drive in spec["drives"]:
-            if "uefi_code.fd" in drive["file"]:
-                vm.hypervisor.exec(["install", "--no-target-directory", "--owner=nobody", "--group=kvm", "--mode=775", vm.hypervisor.config['uefi'][spec['arch']]['code'], drive["file"]], cwd=vm.directory)
-                continue
-            if "uefi_vars.fd" in drive["file"]:
-                vm.hypervisor.exec(["install", "--no-target-directory", "--owner=nobody", "--group=kvm", "--mode=775", vm.hypervisor.config['uefi'][spec['arch']]['vars'], drive["file"]], cwd=vm.directory)
-                continue
-            if "backing_file" in drive:
-                src = vm.hypervisor.images.get(drive["backing_file"]).file
-                dst = os.path.join(vm.directory, drive["backing_file"])
-                vm.hypervisor.make_dir(os.path.dirname(dst))
-                vm.hypervisor.symlink(src, dst)
-            vm.hypervisor.exec(drive.to_qemu_img_args(), cwd=vm.directory)
-        if "cdrom" in spec and spec["cdrom"]:
-            src = vm.hypervisor.images.get(spec["cdrom"]).file
-            dst = os.path.join(vm.directory, spec["cdrom"])
-            vm.hypervisor.make_dir(os.path.dirname(dst))  # TODO this assumes isos are stored in images/subfolder!
-            vm.hypervisor.symlink(src, dst)
+        vm.save_spec(spec)
+        vm.hypervisor.exec(["sh", "-c", vm.provision_script(spec)], cwd=vm.directory)
         return vm
 
     def __init__(self, hypervisor, name):
         self.hypervisor = hypervisor
         self.name = name
         self.directory = os.path.join(self.hypervisor.vms.directory, self.name)
+        self._spec = None
 
     def __repr__(self):
         return f"<Vm {self.name}>"
 
     @property
     def spec(self):
-        with self.hypervisor.open_file(os.path.join(self.directory, "spec.json"), "r") as file:
-            data = json.load(file)
-        return VmSpec(data)
+        if self._spec is None:
+            with self.hypervisor.open_file(os.path.join(self.directory, "spec.json"), "r") as file:
+                self._spec = VmSpec(json.load(file))
+        return self._spec
+
+    def save_spec(self, spec):
+        filename = os.path.join(self.directory, "spec.json")
+        with self.hypervisor.open_file(filename, "w") as file:
+            json.dump(spec, file)
+        self._spec = VmSpec(json.loads(json.dumps(spec)))
+
+    def provision_script(self, spec):
+        uefi = self.hypervisor.config["uefi"][spec["arch"]]
+        links = []
+        commands = ["set -e"]
+        for drive in spec["drives"]:
+            if "uefi_code.fd" in drive["file"]:
+                commands.append(shlex.join(["install", "--no-target-directory", "--owner=nobody", "--group=kvm", "--mode=775", uefi["code"], drive["file"]]))
+            elif "uefi_vars.fd" in drive["file"]:
+                commands.append(shlex.join(["install", "--no-target-directory", "--owner=nobody", "--group=kvm", "--mode=775", uefi["vars"], drive["file"]]))
+            else:
+                if "backing_file" in drive and drive["backing_file"] not in links:
+                    links.append(drive["backing_file"])
+                if "backing_file" in drive and drive["format"] == "raw":
+                    commands.append(shlex.join(["cp", "--reflink=auto", "--sparse=always", drive["backing_file"], drive["file"]]))
+                else:
+                    commands.append(shlex.join(drive.to_qemu_img_args()))
+        if "cdrom" in spec and spec["cdrom"] and spec["cdrom"] not in links:
+            links.append(spec["cdrom"])
+        prepare = []
+        for name in links:
+            src = os.path.join(self.hypervisor.images.directory, name)
+            dst = os.path.join(self.directory, name)
+            prepare += [
+                f"test -f {shlex.quote(src)} || {{ echo {shlex.quote(f'Image {name} does not exist')} >&2; exit 1; }}",
+                shlex.join(["mkdir", "-p", os.path.dirname(dst)]),
+                f'ln -sfn "$(readlink -f {shlex.quote(src)})" {shlex.quote(dst)}',
+            ]
+        return "\n".join(commands[:1] + prepare + commands[1:]) + "\n"
+
+    def snapshot(self):
+        if self.is_running:
+            raise Exception(f"Vm {self.name} must be stopped to snapshot it")
+        template = os.path.join("templates", f"{self.name}-{time.strftime('%Y%m%d%H%M%S')}")
+        directory = os.path.join(self.hypervisor.images.directory, template)
+        images = {}
+        commands = ["set -e", shlex.join(["mkdir", "-p", directory])]
+        for drive in self.spec["drives"]:
+            if drive.get("if") == "pflash":
+                continue
+            dst = os.path.join(directory, os.path.basename(drive["file"]))
+            if drive["format"] == "raw":
+                commands.append(shlex.join(["cp", "--reflink=auto", "--sparse=always", drive["file"], dst]))
+            else:
+                commands.append(shlex.join(["qemu-img", "convert", "-O", drive["format"], drive["file"], dst]))
+            commands.append(shlex.join(["chmod", "a-w", dst]))
+            images[drive["file"]] = os.path.join(template, os.path.basename(drive["file"]))
+        self.hypervisor.exec(["sh", "-c", "\n".join(commands) + "\n"], cwd=self.directory)
+        return images
+
+    def clone_spec(self, name, images):
+        spec = json.loads(json.dumps(self.spec))
+        spec.update({"name": name, "uuid": str(uuid.uuid4())})
+        spec["nics"] = [{key: value for key, value in nic.items() if key not in ["id", "mac"]} for nic in spec["nics"]]
+        drives = []
+        for drive in spec["drives"]:
+            drive = {key: value for key, value in drive.items() if key not in ["id", "size"]}
+            if drive["file"] in images:
+                drive["backing_file"] = images[drive["file"]]
+            drives.append(drive)
+        spec["drives"] = drives
+        return VmSpec(spec)
 
     @property
     def drives(self):
@@ -66,7 +135,7 @@ class Vm:
 
     @property
     def monitor(self):
-        return self.hypervisor.qmp(os.path.join(self.directory, "qmp.sock"))
+        return self.hypervisor.monitor(os.path.join(self.directory, "qmp.sock"))
 
     @property
     def is_running(self):
@@ -76,14 +145,22 @@ class Vm:
         return self.hypervisor.pid_exists(pidfile, "qemu")
 
     @property
-    def address(self):  # TODO: this returns only the first IP
-        for nic in self.spec["nics"]:
+    def addresses(self):
+        return self.addresses_for(self.spec)
+
+    def addresses_for(self, spec):
+        index = self.hypervisor.networks.lease_index()
+        addresses = []
+        for nic in spec["nics"]:
             if "br" not in nic:
                 continue
-            for lease in self.hypervisor.networks.get(nic["br"]).leases:
-                if lease["mac"] == nic["mac"]:
-                    return lease['ip']
-        return None
+            addresses += [ip for ip, network, expiry in index.get(nic["mac"], []) if network == nic["br"]]
+        return addresses
+
+    @property
+    def address(self):
+        addresses = self.addresses
+        return addresses[0] if addresses else None
 
     @property
     def vnc_uri(self):
@@ -91,15 +168,45 @@ class Vm:
             vnc_data = monitor.execute("query-vnc")
         return f"vnc://:{self.spec['vnc']['password']}@{vnc_data['host']}:{vnc_data['service']}"
 
+    def wait_for(self, state, timeout=30):
+        """
+        Wait until the vm reaches `state`: a qmp run state such as running,
+        paused or shutdown, or stopped for the qemu process having exited.
+        """
+        pidfile = os.path.join(self.directory, "pidfile")
+        if state == "stopped":
+            if not self.hypervisor.call("wait_process", pidfile, "qemu", False, timeout):
+                raise TimeoutError(f"Vm {self.name} did not stop within {timeout} seconds")
+            self.hypervisor.monitors.discard(os.path.join(self.directory, "qmp.sock"))
+            return self
+        deadline = time.monotonic() + timeout
+        with self.monitor as monitor:
+            if monitor.execute("query-status")["status"] == state:
+                return self
+            for event in monitor.events(timeout):
+                if STATE_EVENTS.get(event["event"]) == state:
+                    return self
+                if time.monotonic() > deadline:
+                    break
+        raise TimeoutError(f"Vm {self.name} did not reach {state} within {timeout} seconds")
+
+    def events(self, timeout=None):
+        with self.hypervisor.qmp(os.path.join(self.directory, "qmp.sock")) as monitor:
+            yield from monitor.events(timeout)
+
     def start(self):
         spec = self.spec
-        for nic in spec["nics"]:
-            if "br" not in nic:
-                continue
-            network = self.hypervisor.networks.get(nic['br'])
-            if not network.is_running:
-                network.start()
+        with self.hypervisor.networks.lock:
+            for nic in spec["nics"]:
+                if "br" not in nic:
+                    continue
+                network = self.hypervisor.networks.get(nic['br'])
+                if not network.is_running:
+                    network.start().wait_ready()
+        self.hypervisor.monitors.discard(os.path.join(self.directory, "qmp.sock"))
         self.hypervisor.exec(spec.to_qemu_args(), cwd=self.directory)
+        if not self.hypervisor.call("wait_file", os.path.join(self.directory, "qmp.sock"), 30):
+            raise TimeoutError(f"Vm {self.name} did not open its monitor")
         with self.monitor as monitor:
             if spec["vnc"]["password"]:
                 monitor.execute("change-vnc-password", password=spec["vnc"]["password"])
@@ -114,17 +221,23 @@ class Vm:
     def stop(self):
         with self.monitor as monitor:
             monitor.execute("quit")
+        self.hypervisor.monitors.discard(os.path.join(self.directory, "qmp.sock"))
         return self
 
     def destroy(self):
-        self.hypervisor.pid_kill(os.path.join(self.directory, "pidfile"), "qemu")
+        self.hypervisor.monitors.discard(os.path.join(self.directory, "qmp.sock"))
+        if self.hypervisor.pid_kill(os.path.join(self.directory, "pidfile"), "qemu"):
+            self.wait_for("stopped")
         self.hypervisor.remove_dir(self.directory)
+        self.hypervisor.vms.cache.pop(self.name, None)
+        self.hypervisor.images.unreference(self.name)
 
 
 class Vms:
     def __init__(self, hypervisor):
         self.hypervisor = hypervisor
         self.directory = os.path.join(hypervisor.directory, "vms")
+        self.cache = {}
 
     def __contains__(self, value):
         return self.hypervisor.is_dir(os.path.join(self.directory, value))
@@ -132,14 +245,84 @@ class Vms:
     def all(self):
         if not self.hypervisor.is_dir(self.directory):
             return []
-        return [Vm(self.hypervisor, name) for name in self.hypervisor.list_dir(self.directory)]
+        return [self.vm(name) for name in self.hypervisor.list_dir(self.directory)]
+
+    def inventory(self):
+        vms = []
+        for entry in self.hypervisor.call("inventory", self.directory, "qemu"):
+            vm = self.vm(entry["name"])
+            if entry["spec"]:
+                vm._spec = VmSpec(entry["spec"])
+            vms.append((vm, entry["running"], vm._spec))
+        return vms
 
     def get(self, name):
         if name not in self:
             raise Exception(f"Vm {name} does not exist")
-        return Vm(self.hypervisor, name)
+        return self.vm(name)
+
+    def vm(self, name):
+        if name not in self.cache:
+            self.cache[name] = Vm(self.hypervisor, name)
+        return self.cache[name]
+
+    def select(self, patterns):
+        vms = {}
+        names = None
+        for pattern in patterns:
+            if not any(char in pattern for char in "*?["):
+                vms[pattern] = self.get(pattern)
+                continue
+            if names is None:
+                names = sorted(vm.name for vm in self.all())
+            for name in fnmatch.filter(names, pattern):
+                vms[name] = self.vm(name)
+        return list(vms.values())
+
+    def run(self, vms, action, concurrency=8):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(action, vm): vm for vm in vms}
+            for future in as_completed(futures):
+                yield futures[future], future.exception()
+
+    def events(self, vms, timeout=None):
+        """
+        Fan in the qmp events of `vms` and yield (vm, event) as they arrive.
+        Every vm keeps its own monitor connection open while it is watched.
+        """
+        events = queue.Queue()
+
+        def watch(vm):
+            try:
+                for event in vm.events(timeout):
+                    events.put((vm, event))
+            except Exception as error:
+                logging.warning(f"Vm {vm.name} stopped sending events: {error}")
+            finally:
+                events.put((vm, None))
+
+        for vm in vms:
+            threading.Thread(target=watch, args=(vm,), daemon=True).start()
+        remaining = len(vms)
+        while remaining:
+            vm, event = events.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield vm, event
+
+    def clone(self, source, names, concurrency=8):
+        source = self.get(source)
+        for name in names:
+            if name in self:
+                raise Exception(f"Vm {name} already exists")
+        images = source.snapshot()
+        logging.info(f"Vm {source.name} snapshotted to {', '.join(images.values()) or 'an empty template'}")
+        yield from self.run(names, lambda name: self.create(source.clone_spec(name, images)), concurrency)
 
     def create(self, spec):
         if spec["name"] in self:
             raise Exception("Vm already exists")
-        return Vm.create_from_spec(self.hypervisor, spec)
+        vm = self.cache[spec["name"]] = Vm.create_from_spec(self.hypervisor, spec)
+        self.hypervisor.images.reference(vm.name, vm.spec)
+        return vm
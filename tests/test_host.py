@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import threading
+
+from qemu import host
+from qemu.hypervisor import Hypervisor
+from unittest.mock import patch
+
+
+def test_process_running(tmp_path):
+    pidfile = tmp_path / "pidfile"
+    assert not host.process_running(str(pidfile))
+    pidfile.write_text(f"{os.getpid()}\n")
+    with open(f"/proc/{os.getpid()}/comm") as file:
+        comm = file.read().strip()
+    assert host.process_running(str(pidfile))
+    assert host.process_running(str(pidfile), comm[:4])
+    assert not host.process_running(str(pidfile), "dnsmasq")
+
+
+def test_wait(tmp_path):
+    filename = tmp_path / "qmp.sock"
+    threading.Timer(0.05, filename.write_text, args=("",)).start()
+    assert host.wait_file(str(filename), 5)
+    assert not host.wait_file(str(tmp_path / "missing"), 0.05)
+    process = subprocess.Popen(["sleep", "5"])
+    pidfile = tmp_path / "pidfile"
+    pidfile.write_text(str(process.pid))
+    assert host.wait_process(str(pidfile), "sleep", True, 1)
+    threading.Timer(0.05, process.kill).start()
+    threading.Timer(0.1, pidfile.unlink).start()
+    assert host.wait_process(str(pidfile), "sleep", False, 5)
+    process.wait()
+
+
+def test_inventory(tmp_path):
+    assert host.inventory(str(tmp_path / "missing")) == []
+    (tmp_path / "vm1").mkdir()
+    (tmp_path / "vm1" / "spec.json").write_text(json.dumps({"name": "vm1"}))
+    (tmp_path / "vm1" / "pidfile").write_text(str(os.getpid()))
+    (tmp_path / "vm2").mkdir()
+    (tmp_path / "stray.txt").write_text("")
+    assert host.inventory(str(tmp_path)) == [
+        {"name": "vm1", "running": True, "spec": {"name": "vm1"}},
+        {"name": "vm2", "running": False, "spec": None},
+    ]
+
+
+def test_hypervisor_call(tmp_path):
+    h = Hypervisor(str(tmp_path))
+    assert h.call("inventory", str(tmp_path), "qemu") == []
+
+
+def test_image_info(tmp_path):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "a.qcow2").write_bytes(b"a")
+    (tmp_path / "images" / "b.qcow2").write_bytes(b"b")
+    files = [str(tmp_path / "images" / name) for name in ["a.qcow2", "b.qcow2", "c.qcow2"]]
+    cache_file = str(tmp_path / "cache" / "images.json")
+    with patch("qemu.host.run", side_effect=lambda command: (0, json.dumps({"filename": command[-1]}), "")) as mock_run:
+        assert host.image_info(files, cache_file) == {files[0]: {"filename": files[0]}, files[1]: {"filename": files[1]}}
+        assert mock_run.call_count == 2
+        assert host.image_info(files, cache_file) == {files[0]: {"filename": files[0]}, files[1]: {"filename": files[1]}}
+        assert mock_run.call_count == 2
+        (tmp_path / "images" / "b.qcow2").write_bytes(b"bb")
+        host.image_info(files, cache_file)
+        assert mock_run.call_count == 3
@@ -1,4 +1,7 @@
+import asyncio
+
 from qemu.hypervisor import Hypervisor
+from qemu.hypervisor_async import AsyncHypervisor
 from unittest.mock import patch
 
 
@@ -15,3 +18,29 @@ def test_hypervisor_exec(mock_run):
     h.pid_kill("pidfile", "qemu")
     h.pid_exists("pidfile")
     h.pid_exists("pidfile", "qemu")
+
+
+def test_async_hypervisor():
+    async def main():
+        async with AsyncHypervisor(Hypervisor("/tmp"), concurrency=4) as ahv:
+            assert ahv.directory == "/tmp"
+            results = await asyncio.gather(*[ahv.exec(["echo", str(index)]) for index in range(8)])
+            assert results == [f"{index}\n" for index in range(8)]
+            assert await ahv.is_dir("/tmp")
+
+    asyncio.run(main())
+
+
+def test_hypervisor_walk(tmp_path):
+    (tmp_path / "images" / "with space").mkdir(parents=True)
+    (tmp_path / "images" / "with space" / "disk.qcow2").write_bytes(b"data")
+    (tmp_path / "images" / "link.qcow2").symlink_to(tmp_path / "images" / "with space" / "disk.qcow2")
+    (tmp_path / "outside.qcow2").write_bytes(b"")
+    h = Hypervisor(str(tmp_path))
+    entries = sorted(h.walk(str(tmp_path / "images")))
+    assert [(entry.path, entry.size, entry.type) for entry in entries] == [
+        (str(tmp_path / "images" / "link.qcow2"), 4, "l"),
+        (str(tmp_path / "images" / "with space" / "disk.qcow2"), 4, "f"),
+    ]
+    assert entries[0].mtime == h.mtime(str(tmp_path / "images" / "with space" / "disk.qcow2"))
+    assert list(h.walk(str(tmp_path / "missing"))) == []
@@ -0,0 +1,87 @@
+import inspect
+import json
+import os
+import pytest
+import socket
+import subprocess
+import threading
+
+from qemu import host
+from qemu.hypervisor_agent import HypervisorAgent
+from unittest.mock import patch
+
+
+@pytest.fixture
+def agent(tmp_path):
+    process = subprocess.Popen(["python3", "-c", inspect.getsource(host), "serve"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    with patch.object(HypervisorAgent, "spawn_agent", return_value=(process.stdin, process.stdout)):
+        hypervisor = HypervisorAgent(f"ssh://localhost{tmp_path}")
+        yield hypervisor
+        hypervisor.close()
+    process.wait(timeout=5)
+
+
+def test_agent_files(agent, tmp_path):
+    agent.make_dir(str(tmp_path / "vms" / "vm1"))
+    assert agent.is_dir(str(tmp_path / "vms" / "vm1"))
+    with agent.open_file(str(tmp_path / "vms" / "vm1" / "spec.json"), "w") as file:
+        json.dump({"name": "vm1"}, file)
+    assert agent.is_file(str(tmp_path / "vms" / "vm1" / "spec.json"))
+    with agent.open_file(str(tmp_path / "vms" / "vm1" / "spec.json")) as file:
+        assert json.load(file) == {"name": "vm1"}
+    assert agent.list_dir(str(tmp_path / "vms")) == ["vm1"]
+    spec = str(tmp_path / "vms" / "vm1" / "spec.json")
+    assert agent.walk(str(tmp_path)) == [(spec, agent.size(spec), agent.mtime(spec), "f")]
+    assert agent.call("inventory", str(tmp_path / "vms"), "qemu") == [{"name": "vm1", "running": False, "spec": {"name": "vm1"}}]
+    with pytest.raises(FileNotFoundError):
+        agent.remove_file(str(tmp_path / "missing"))
+    agent.remove_dir(str(tmp_path / "vms"))
+    assert not agent.is_dir(str(tmp_path / "vms"))
+
+
+def test_agent_exec(agent, tmp_path):
+    assert agent.exec(["pwd"]) == f"{tmp_path}\n"
+    assert agent.exec(["false"], check=False) == ""
+    assert agent.exec(["sh", "-c", "command -v python3"]).strip().endswith("python3")
+    with pytest.raises(Exception):
+        agent.exec(["false"])
+    results = {}
+    threads = [threading.Thread(target=lambda index=index: results.update({index: agent.exec(["echo", str(index)])})) for index in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {index: f"{index}\n" for index in range(16)}
+    pidfile = tmp_path / "pidfile"
+    pidfile.write_text(str(os.getpid()))
+    assert agent.pid_exists(str(pidfile))
+    assert not agent.pid_exists(str(pidfile), "dnsmasq")
+
+
+def test_agent_qmp(agent, tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def monitor():
+        conn, _ = server.accept()
+        with conn, conn.makefile("rwb") as file:
+            file.write(b'{"QMP":{"version":{},"capabilities":[]}}\r\n')
+            file.flush()
+            for line in file:
+                command = json.loads(line)
+                file.write(json.dumps({"id": command["id"], "return": {"command": command["execute"]}}).encode() + b"\r\n")
+                file.flush()
+
+    threading.Thread(target=monitor, daemon=True).start()
+    with agent.qmp(path) as qmp:
+        assert qmp.execute("query-status") == {"command": "query-status"}
+        assert list(qmp.events(timeout=0.1)) == []
+    threading.Thread(target=monitor, daemon=True).start()
+    with agent.monitor(path) as qmp:
+        assert qmp.execute("query-status") == {"command": "query-status"}
+    agent.close()
+    assert agent.spawn_agent.call_count == 1
+    assert agent._agent is None
+    server.close()
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from qemu.hypervisor_ssh import HypervisorSSH
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+
+def fake_channel(active, peak, lock):
+    channel = MagicMock()
+
+    def exec_command(command):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+
+    channel.exec_command.side_effect = exec_command
+    channel.makefile.return_value.read.return_value = b"ok\n"
+    channel.makefile_stderr.return_value.read.return_value = b""
+    channel.recv_exit_status.return_value = 0
+    return channel
+
+
+@patch("paramiko.SSHClient")
+def test_hypervisor_ssh_exec_concurrency(mock_client):
+    active, peak, lock = [0], [0], threading.Lock()
+    mock_client.return_value.get_transport.return_value.open_session.side_effect = lambda: fake_channel(active, peak, lock)
+    h = HypervisorSSH("ssh://root@localhost/srv/qemu", max_sessions=2, connections=2)
+    threads = [threading.Thread(target=h.exec, args=(["true"],)) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_client.call_count == 2
+    assert 1 < peak[0] <= 4
+    assert h.exec(["echo", "ok"]) == "ok\n"
+    h.close()
+    assert h._clients == [None, None]
+
+
+@patch("paramiko.SSHClient")
+def test_hypervisor_ssh_qmp_channels_share_the_session_limit(mock_client):
+    h = HypervisorSSH("ssh://root@localhost/srv/qemu", max_sessions=2)
+    first = h.qmp("/srv/qemu/vms/vm1/qmp.sock")
+    second = h.qmp("/srv/qemu/vms/vm2/qmp.sock")
+    assert not h._semaphores[0].acquire(blocking=False)
+    first.close()
+    first.close()
+    assert h._semaphores[0].acquire(blocking=False)
+    h._semaphores[0].release()
+    second.close()
+    assert h.monitors.max_size == 1
+
+
+@patch("paramiko.SSHClient")
+def test_hypervisor_ssh_walk(mock_client):
+    h = HypervisorSSH("ssh://root@localhost/srv/qemu")
+    with patch.object(h, "exec", return_value="/srv/qemu/images/a b.qcow2\x004\x001700000000.5\x00f\x00/srv/qemu/images/c\x0010\x001700000001.0\x00l\x00") as mock_exec:
+        assert list(h.walk("/srv/qemu/images")) == [
+            ("/srv/qemu/images/a b.qcow2", 4, 1700000000, "f"),
+            ("/srv/qemu/images/c", 10, 1700000001, "l"),
+        ]
+    assert mock_exec.call_args[0][0][:5] == ["find", "-L", "/srv/qemu/images", "-type", "f"]
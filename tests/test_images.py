@@ -0,0 +1,145 @@
+import hashlib
+import io
+import json
+import lzma
+import os
+import pytest
+import tarfile
+
+from qemu.hypervisor import Hypervisor
+from qemu.images import skip
+from qemu.images import source_identity
+from qemu.specs import VmSpec
+from unittest.mock import patch
+
+
+def test_images_create_from_file(tmp_path):
+    source = tmp_path / "disk.qcow2"
+    source.write_bytes(os.urandom(1024 * 1024))
+    h = Hypervisor(str(tmp_path / "qemu"))
+    progress = []
+    image = h.images.create("base/disk.qcow2", str(source), progress=lambda position, total: progress.append((position, total)))
+    assert image.name == "base/disk.qcow2"
+    assert (tmp_path / "qemu" / "images" / "base" / "disk.qcow2").read_bytes() == source.read_bytes()
+    assert progress[-1] == (1024 * 1024, 1024 * 1024)
+    assert not os.listdir(tmp_path / "qemu" / "cache" / "uploads" / "base")
+    digest = hashlib.sha256(source.read_bytes()).hexdigest()
+    assert image.blob == str(tmp_path / "qemu" / "blobs" / "sha256" / digest)
+    assert image.verify()
+
+
+def test_images_create_resumes(tmp_path):
+    data = os.urandom(1024 * 1024)
+    source = tmp_path / "disk.raw.xz"
+    source.write_bytes(lzma.compress(data))
+    (tmp_path / "qemu" / "cache" / "uploads").mkdir(parents=True)
+    (tmp_path / "qemu" / "cache" / "uploads" / "disk.raw.part").write_bytes(data[:1000])
+    (tmp_path / "qemu" / "cache" / "uploads" / "disk.raw.part.json").write_text(json.dumps(source_identity(str(source))))
+    h = Hypervisor(str(tmp_path / "qemu"))
+    with patch("qemu.images.skip", wraps=skip) as mock_skip:
+        h.images.create("disk.raw", str(source))
+    assert mock_skip.call_args[0][1] == 1000
+    assert (tmp_path / "qemu" / "images" / "disk.raw").read_bytes() == data
+
+
+def test_images_create_restarts_uploads_from_another_source(tmp_path):
+    data = os.urandom(1024 * 1024)
+    source = tmp_path / "disk.raw"
+    source.write_bytes(data)
+    (tmp_path / "qemu" / "cache" / "uploads").mkdir(parents=True)
+    (tmp_path / "qemu" / "cache" / "uploads" / "disk.raw.part").write_bytes(os.urandom(1000))
+    (tmp_path / "qemu" / "cache" / "uploads" / "disk.raw.part.json").write_text(json.dumps(source_identity(str(tmp_path / "disk.raw"), "other.img")))
+    h = Hypervisor(str(tmp_path / "qemu"))
+    h.images.create("disk.raw", str(source))
+    assert (tmp_path / "qemu" / "images" / "disk.raw").read_bytes() == data
+    assert not os.listdir(tmp_path / "qemu" / "cache" / "uploads")
+
+
+def test_images_create_from_box(tmp_path):
+    data = os.urandom(1024 * 1024)
+    source = tmp_path / "libvirt.box"
+    with tarfile.open(source, "w:gz") as archive:
+        for name, content in [("metadata.json", b"{}"), ("box.img", data)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    h = Hypervisor(str(tmp_path / "qemu"))
+    h.images.create("alpine.qcow2", str(source))
+    assert (tmp_path / "qemu" / "images" / "alpine.qcow2").read_bytes() == data
+
+
+def test_images_are_deduplicated(tmp_path):
+    data = os.urandom(1024)
+    (tmp_path / "a.img").write_bytes(data)
+    (tmp_path / "b.img").write_bytes(data)
+    h = Hypervisor(str(tmp_path / "qemu"))
+    a = h.images.create("a.img", str(tmp_path / "a.img"))
+    b = h.images.create("b.img", str(tmp_path / "b.img"))
+    assert a.blob == b.blob
+    assert os.listdir(tmp_path / "qemu" / "blobs" / "sha256") == [os.path.basename(a.blob)]
+    c = b.rename("renamed/c.img")
+    assert c.blob == a.blob
+    assert sorted(image.name for image in h.images.all()) == ["a.img", "renamed/c.img"]
+    assert [image.size for image in h.images.all()] == [1024, 1024]
+
+
+def test_images_delete_reclaims_blob(tmp_path):
+    (tmp_path / "a.img").write_bytes(b"same")
+    h = Hypervisor(str(tmp_path / "qemu"))
+    a = h.images.create("a.img", str(tmp_path / "a.img"))
+    b = h.images.create("b.img", str(tmp_path / "a.img"))
+    a.delete()
+    assert os.path.exists(b.blob)
+    blob = b.blob
+    b.delete()
+    assert not os.path.exists(blob)
+
+
+def test_images_dedup(tmp_path):
+    (tmp_path / "qemu" / "images").mkdir(parents=True)
+    (tmp_path / "qemu" / "images" / "a.img").write_bytes(b"same")
+    (tmp_path / "qemu" / "images" / "b.img").write_bytes(b"same")
+    h = Hypervisor(str(tmp_path / "qemu"))
+    assert sorted(image.name for image in h.images.dedup()) == ["a.img", "b.img"]
+    assert h.images.get("a.img").blob == h.images.get("b.img").blob
+    assert h.images.get("a.img").verify()
+    assert h.images.dedup() == []
+
+
+def test_images_references(tmp_path):
+    for name in ["base.qcow2", "other.qcow2"]:
+        (tmp_path / name).write_bytes(name.encode())
+    h = Hypervisor(str(tmp_path / "qemu"))
+    h.images.create("base.qcow2", str(tmp_path / "base.qcow2"))
+    h.images.create("isos/other.iso", str(tmp_path / "other.qcow2"))
+    (tmp_path / "qemu" / "vms" / "vm1").mkdir(parents=True)
+    (tmp_path / "qemu" / "vms" / "vm1" / "spec.json").write_text(json.dumps(VmSpec({
+        "name": "vm1",
+        "machine": "pc",
+        "drives": ["backing_file=base.qcow2"],
+    })))
+    assert h.images.references() == {"base.qcow2": {"vm1"}}
+    with pytest.raises(Exception, match="used by vm1"):
+        h.images.get("base.qcow2").delete()
+    with patch.object(h, "exec"):
+        h.vms.create(VmSpec({"name": "vm2", "machine": "pc", "drives": ["backing_file=base.qcow2"], "cdrom": "isos/other.iso"}))
+    assert h.images.references() == {"base.qcow2": {"vm1", "vm2"}, "isos/other.iso": {"vm2"}}
+    h.vms.get("vm2").destroy()
+    assert h.images.references() == {"base.qcow2": {"vm1"}}
+    h.images.get("isos/other.iso").delete()
+
+
+def test_images_gc(tmp_path):
+    for name in ["base.qcow2", "template.qcow2"]:
+        (tmp_path / name).write_bytes(name.encode())
+    h = Hypervisor(str(tmp_path / "qemu"))
+    h.images.create("base.qcow2", str(tmp_path / "base.qcow2"))
+    h.images.create("templates/vm1/disk.qcow2", str(tmp_path / "template.qcow2"))
+    orphan = tmp_path / "qemu" / "blobs" / "sha256" / "orphan"
+    orphan.write_bytes(b"")
+    assert h.images.gc(dry_run=True) == ["templates/vm1/disk.qcow2", str(orphan)]
+    assert orphan.exists()
+    assert h.images.gc() == ["templates/vm1/disk.qcow2", str(orphan)]
+    assert not orphan.exists()
+    assert len(os.listdir(tmp_path / "qemu" / "blobs" / "sha256")) == 1
+    assert h.images.get("base.qcow2").verify()
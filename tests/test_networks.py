@@ -1,5 +1,9 @@
+import os
+
+from qemu.hypervisor import Hypervisor
 from qemu.networks import generate_dnsmasq_config
 from qemu.specs import NetworkSpec
+from unittest.mock import patch
 
 
 def test_config_with_basics():
@@ -39,3 +43,26 @@ def test_config_with_dhcp():
     assert "dhcp-lease-max=253" in config
     assert "dhcp-hostsfile=/tmp/hostsfile" in config
     assert "dhcp-leasefile=/tmp/leases" in config
+
+
+def test_lease_index(tmp_path):
+    (tmp_path / "networks" / "br0").mkdir(parents=True)
+    (tmp_path / "networks" / "br1").mkdir(parents=True)
+    (tmp_path / "networks" / "br0" / "leases").write_text(
+        "1700000000 52:54:00:00:00:01 10.0.0.10 vm1 *\n"
+        "1700000100 52:54:00:00:00:02 10.0.0.11 vm2 *\n"
+    )
+    (tmp_path / "networks" / "br1" / "leases").write_text(
+        "1700000200 52:54:00:00:00:01 10.0.1.10 vm1 *\n"
+    )
+    h = Hypervisor(str(tmp_path))
+    index = h.networks.lease_index()
+    assert index["52:54:00:00:00:01"] == [("10.0.1.10", "br1", 1700000200), ("10.0.0.10", "br0", 1700000000)]
+    assert index["52:54:00:00:00:02"] == [("10.0.0.11", "br0", 1700000100)]
+    assert h.networks.lease_index() is index
+    with patch("qemu.host.open", create=True, side_effect=AssertionError) as mock_open:
+        assert h.networks.lease_index(refresh=True) == index
+        assert not mock_open.called
+    (tmp_path / "networks" / "br1" / "leases").write_text("")
+    os.utime(tmp_path / "networks" / "br1" / "leases", (0, 0))
+    assert h.networks.lease_index(refresh=True)["52:54:00:00:00:01"] == [("10.0.0.10", "br0", 1700000000)]
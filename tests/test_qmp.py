@@ -1,6 +1,13 @@
+import asyncio
+import json
 import pytest
+import socket
+import threading
 
+from qemu.qmp import AsyncQmp
 from qemu.qmp import Qmp
+from qemu.qmp import QmpPool
+from unittest.mock import MagicMock
 from unittest.mock import patch
 
 
@@ -10,7 +17,7 @@ def test_qmp_not_available(mock_socket):
     assert isinstance(qmp, Qmp)
     assert qmp.conn.path == "fuubar.sock"
     assert not qmp.conn.socket
-    assert qmp.events == []
+    assert qmp.backlog == []
     with pytest.raises(RuntimeError, match="Qmp monitor not available"):
         qmp.open()
     qmp.close()
@@ -21,14 +28,14 @@ def test_qmp_not_available(mock_socket):
 @patch("socket.socket")
 def test_qmp_available(mock_socket, mock_read):
     mock_read.side_effect = (
-        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}',
-        b'{"return":{}}',
+        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}\r\n',
+        b'{"return":{}}\r\n',
     )
     with Qmp.from_local_socket("fuubar.sock") as qmp:
         assert qmp.conn.socket
-        assert qmp.events == []
+        assert qmp.backlog == []
     assert not qmp.conn.socket
-    assert qmp.events == []
+    assert qmp.backlog == []
 
 
 @patch("binascii.b2a_hex")
@@ -37,19 +44,19 @@ def test_qmp_available(mock_socket, mock_read):
 def test_qmp_query_status(mock_socket, mock_read, mock_b2a_hex):
     mock_b2a_hex.return_value = b"182912"
     mock_read.side_effect = (
-        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}',
-        b'{"return":{}}',
-        b'{"event":"BLOCK_IO_ERROR","data":{"device":"ide0-hd1"},"timestamp":{"seconds":1265044230,"microseconds":450486}}\n{"id":"182912","return":{"status":"running","singlestep":false,"running":true}}',
+        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}\r\n',
+        b'{"return":{}}\r\n',
+        b'{"event":"BLOCK_IO_ERROR","data":{"device":"ide0-hd1"},"timestamp":{"seconds":1265044230,"microseconds":450486}}\n{"id":"182912","return":{"status":"running","singlestep":false,"running":true}}\r\n',
     )
     with Qmp.from_local_socket("fuubar.sock") as qmp:
         status = qmp.execute("query-status")
-        assert len(qmp.events) == 1
-        assert qmp.events[0]['event'] == 'BLOCK_IO_ERROR'
-        assert qmp.events[0]['data']['device'] == 'ide0-hd1'
+        assert len(qmp.backlog) == 1
+        assert qmp.backlog[0]['event'] == 'BLOCK_IO_ERROR'
+        assert qmp.backlog[0]['data']['device'] == 'ide0-hd1'
     assert status["status"] == "running"
     assert 'id' not in status
     assert not qmp.conn.socket
-    assert qmp.events == []
+    assert qmp.backlog == []
 
 
 @patch("binascii.b2a_hex")
@@ -58,9 +65,9 @@ def test_qmp_query_status(mock_socket, mock_read, mock_b2a_hex):
 def test_qmp_error(mock_socket, mock_read, mock_b2a_hex):
     mock_b2a_hex.return_value = b"182912"
     mock_read.side_effect = (
-        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}',
-        b'{"return":{}}',
-        b'{"error":{"desc":"Something went wrong"}}',
+        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}\r\n',
+        b'{"return":{}}\r\n',
+        b'{"error":{"desc":"Something went wrong"}}\r\n',
     )
     with pytest.raises(RuntimeError, match="Something went wrong"):
         qmp = Qmp.from_local_socket("fuubar.sock")
@@ -68,3 +75,183 @@ def test_qmp_error(mock_socket, mock_read, mock_b2a_hex):
     assert qmp.conn.socket
     qmp.close()
     assert not qmp.conn.socket
+
+
+@patch("os.read")
+@patch("socket.socket")
+def test_qmp_routes_responses_by_id(mock_socket, mock_read):
+    mock_read.side_effect = (
+        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}\r\n',
+        b'{"return":{}}\r\n',
+        b'{"id":"other","return":{"status":"paused"}}\n{"id":"182912","return":{"status":"running"}}\r\n',
+    )
+    qmp = Qmp.from_local_socket("fuubar.sock")
+    with patch("binascii.b2a_hex", return_value=b"182912"):
+        assert qmp.execute("query-status") == {"status": "running"}
+    assert qmp.responses == {"other": {"id": "other", "return": {"status": "paused"}}}
+    qmp.close()
+
+
+@patch("os.read")
+@patch("socket.socket")
+def test_qmp_connection_closed(mock_socket, mock_read):
+    mock_read.side_effect = (
+        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capabilities":[]}}\r\n',
+        b'{"return":{}}\r\n',
+        b'',
+    )
+    with pytest.raises(ConnectionError):
+        with Qmp.from_local_socket("fuubar.sock") as qmp:
+            qmp.execute("query-status")
+
+
+def test_qmp_pool_reuses_sessions():
+    created = []
+
+    def factory(path):
+        qmp = MagicMock()
+        created.append(qmp)
+        return qmp
+
+    pool = QmpPool(factory)
+    with pool.session("vm1.sock") as first:
+        first.execute("query-status")
+    with pool.session("vm1.sock") as second:
+        second.execute("cont")
+    assert first is second
+    assert len(created) == 1
+    with pool.session("vm2.sock"):
+        pass
+    assert len(created) == 2
+    pool.close()
+    assert pool.sessions == {}
+    assert created[0].close.called
+
+
+def test_qmp_pool_discards_broken_sessions():
+    pool = QmpPool(lambda path: MagicMock())
+    with pytest.raises(ConnectionError):
+        with pool.session("vm1.sock") as qmp:
+            raise ConnectionError()
+    assert pool.sessions == {}
+    assert qmp.close.called
+
+
+def test_qmp_pool_evicts_idle_sessions():
+    pool = QmpPool(lambda path: MagicMock(), idle_timeout=0)
+    with pool.session("vm1.sock") as qmp:
+        pass
+    pool.evict()
+    assert pool.sessions == {}
+    assert qmp.close.called
+
+
+def test_qmp_pool_closes_least_recently_used_sessions():
+    pool = QmpPool(lambda path: MagicMock(), max_size=2)
+    for path in ["vm1.sock", "vm2.sock", "vm1.sock", "vm3.sock"]:
+        with pool.session(path):
+            pass
+    assert list(pool.sessions) == ["vm1.sock", "vm3.sock"]
+    with pool.session("vm1.sock") as first:
+        with pool.session("vm2.sock"):
+            with pool.session("vm3.sock"):
+                assert len(pool.sessions) == 3
+    assert list(pool.sessions) == ["vm1.sock", "vm2.sock"]
+    assert not first.close.called
+
+
+def test_qmp_pool_discards_sessions_failing_the_handshake():
+    created = []
+
+    def factory(path):
+        qmp = MagicMock()
+        qmp.open.side_effect = RuntimeError("Qmp monitor not available") if not created else None
+        created.append(qmp)
+        return qmp
+
+    pool = QmpPool(factory)
+    with pytest.raises(RuntimeError):
+        with pool.session("vm1.sock"):
+            pass
+    assert pool.sessions == {}
+    with pool.session("vm1.sock") as qmp:
+        assert qmp is created[1]
+
+
+@patch("binascii.b2a_hex")
+@patch("os.read")
+@patch("socket.socket")
+def test_qmp_reads_fragmented_messages(mock_socket, mock_read, mock_b2a_hex):
+    mock_b2a_hex.return_value = b"182912"
+    schema = [{"name": f"command-{index}", "meta-type": "command"} for index in range(5000)]
+    response = json.dumps({"id": "182912", "return": schema}).encode() + b"\r\n"
+    mock_read.side_effect = [
+        b'{"QMP":{"version":{"qemu":{"micro":0,"minor":6,"major":1},"package":""},"capa',
+        b'bilities":[]}}\r\n{"return"',
+        b':{}}\r\n{"event":"STOP","data":{}}\r\n',
+    ] + [response[offset:offset + 1024] for offset in range(0, len(response), 1024)]
+    with Qmp.from_local_socket("fuubar.sock") as qmp:
+        assert qmp.execute("query-qmp-schema") == schema
+        assert [event["event"] for event in qmp.backlog] == ["STOP"]
+        assert len(qmp.buffer) == 0
+
+
+def test_async_qmp(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+
+    async def monitor(reader, writer):
+        writer.write(b'{"QMP":{"version":{},"capabilities":["oob"]}}\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = json.loads(line)
+            if command["execute"] == "stop":
+                writer.write(b'{"event":"STOP","data":{}}\r\n')
+            if command["execute"] == "fail":
+                writer.write(json.dumps({"id": command["id"], "error": {"desc": "Something went wrong"}}).encode() + b"\r\n")
+            else:
+                writer.write(json.dumps({"id": command["id"], "return": {"command": command["execute"]}}).encode() + b"\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_unix_server(monitor, path)
+        async with AsyncQmp.from_local_socket(path, timeout=5) as qmp:
+            results = await asyncio.gather(*[qmp.execute(f"query-{index}") for index in range(10)])
+            assert [result["command"] for result in results] == [f"query-{index}" for index in range(10)]
+            with pytest.raises(RuntimeError, match="Something went wrong"):
+                await qmp.execute("fail")
+            await qmp.execute("stop")
+            assert [event["event"] async for event in qmp.listen(timeout=0.1)] == ["STOP"]
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_qmp_events(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    done = threading.Event()
+
+    def monitor():
+        conn, _ = server.accept()
+        with conn, conn.makefile("rwb") as file:
+            file.write(b'{"QMP":{"version":{},"capabilities":[]}}\r\n')
+            file.flush()
+            command = json.loads(file.readline())
+            file.write(json.dumps({"id": command["id"], "return": {}}).encode() + b'\r\n{"event":"RESUME","data":{}}\r\n')
+            file.flush()
+            file.write(b'{"event":"SHUTDOWN","data":{"guest":true}}\r\n')
+            file.flush()
+            done.wait(5)
+
+    threading.Thread(target=monitor, daemon=True).start()
+    with Qmp.from_local_socket(path) as qmp:
+        assert [event["event"] for event in qmp.events(timeout=0.2)] == ["RESUME", "SHUTDOWN"]
+        done.set()
+        assert list(qmp.events()) == []
+    server.close()
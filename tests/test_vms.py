@@ -0,0 +1,210 @@
+import json
+import os
+import pytest
+import socket
+import subprocess
+import threading
+
+from qemu.hypervisor import Hypervisor
+from qemu.specs import VmSpec
+from unittest.mock import patch
+
+
+def test_vms_select(tmp_path):
+    for name in ["web-1", "web-2", "db-1"]:
+        (tmp_path / "vms" / name).mkdir(parents=True)
+    h = Hypervisor(str(tmp_path))
+    assert [vm.name for vm in h.vms.select(["web-*"])] == ["web-1", "web-2"]
+    assert [vm.name for vm in h.vms.select(["db-1", "web-?", "web-1"])] == ["db-1", "web-1", "web-2"]
+    assert h.vms.select(["app-*"]) == []
+    with pytest.raises(Exception, match="Vm app-1 does not exist"):
+        h.vms.select(["app-1"])
+
+
+def test_vms_run(tmp_path):
+    for name in ["web-1", "web-2", "db-1"]:
+        (tmp_path / "vms" / name).mkdir(parents=True)
+    h = Hypervisor(str(tmp_path))
+
+    def action(vm):
+        if vm.name == "db-1":
+            raise RuntimeError("boom")
+
+    results = {vm.name: error for vm, error in h.vms.run(h.vms.select(["*"]), action, concurrency=2)}
+    assert results["web-1"] is None
+    assert results["web-2"] is None
+    assert str(results["db-1"]) == "boom"
+
+
+def test_vm_spec_is_memoized(tmp_path):
+    (tmp_path / "vms" / "vm1").mkdir(parents=True)
+    (tmp_path / "vms" / "vm1" / "spec.json").write_text(json.dumps({"name": "vm1", "machine": "pc"}))
+    h = Hypervisor(str(tmp_path))
+    vm = h.vms.get("vm1")
+    assert h.vms.get("vm1") is vm
+    assert h.vms.all() == [vm]
+    with patch.object(h, "open_file", wraps=h.open_file) as mock_open_file:
+        assert vm.spec["name"] == "vm1"
+        assert vm.spec is vm.spec
+        assert mock_open_file.call_count == 1
+        vm.save_spec({"name": "vm1", "machine": "q35"})
+        assert vm.spec["machine"] == {"type": "q35"}
+        assert mock_open_file.call_count == 2
+
+
+def test_vms_inventory_seeds_specs(tmp_path):
+    (tmp_path / "vms" / "vm1").mkdir(parents=True)
+    (tmp_path / "vms" / "vm1" / "spec.json").write_text(json.dumps({"name": "vm1", "machine": "pc"}))
+    h = Hypervisor(str(tmp_path))
+    [(vm, running, spec)] = h.vms.inventory()
+    assert not running
+    with patch.object(h, "open_file") as mock_open_file:
+        assert vm.spec is spec
+        assert h.vms.get("vm1").spec is spec
+        assert not mock_open_file.called
+
+
+def test_vm_addresses(tmp_path):
+    (tmp_path / "vms" / "vm1").mkdir(parents=True)
+    (tmp_path / "vms" / "vm1" / "spec.json").write_text(json.dumps({
+        "name": "vm1",
+        "machine": "pc",
+        "nics": ["br0,mac=52:54:00:00:00:01", "br1,mac=52:54:00:00:00:02", "type=none"],
+    }))
+    (tmp_path / "networks" / "br0").mkdir(parents=True)
+    (tmp_path / "networks" / "br0" / "leases").write_text("1700000000 52:54:00:00:00:01 10.0.0.10 vm1 *\n")
+    (tmp_path / "networks" / "br1").mkdir(parents=True)
+    (tmp_path / "networks" / "br1" / "leases").write_text("1700000000 52:54:00:00:00:02 10.0.1.10 vm1 *\n")
+    h = Hypervisor(str(tmp_path))
+    vm = h.vms.get("vm1")
+    assert vm.addresses == ["10.0.0.10", "10.0.1.10"]
+    assert vm.address == "10.0.0.10"
+    [(vm, running, spec)] = h.vms.inventory()
+    with patch.object(h, "open_file") as mock_open_file:
+        assert vm.addresses_for(spec) == ["10.0.0.10", "10.0.1.10"]
+        assert not mock_open_file.called
+
+
+def test_vm_create_from_spec(tmp_path):
+    (tmp_path / "images" / "base").mkdir(parents=True)
+    (tmp_path / "images" / "base" / "alpine.qcow2").write_bytes(b"")
+    (tmp_path / "images" / "isos").mkdir(parents=True)
+    (tmp_path / "images" / "isos" / "alpine.iso").write_bytes(b"")
+    h = Hypervisor(str(tmp_path))
+    spec = VmSpec({
+        "name": "vm1",
+        "machine": "pc",
+        "drives": ["backing_file=base/alpine.qcow2", "data.qcow2,size=10G"],
+        "cdrom": "isos/alpine.iso",
+        "vnc": "127.0.0.1",
+    })
+    with patch.object(h, "exec") as mock_exec:
+        vm = h.vms.create(spec)
+    assert mock_exec.call_count == 1
+    script = mock_exec.call_args[0][0][2]
+    assert f'ln -sfn "$(readlink -f {tmp_path}/images/base/alpine.qcow2)" {tmp_path}/vms/vm1/base/alpine.qcow2' in script
+    assert f'ln -sfn "$(readlink -f {tmp_path}/images/isos/alpine.iso)" {tmp_path}/vms/vm1/isos/alpine.iso' in script
+    assert "qemu-img create -F qcow2 -b base/alpine.qcow2 -f qcow2 hd0.qcow2" in script
+    assert "qemu-img create -f qcow2 data.qcow2 10G" in script
+    assert script.index("ln -sfn") < script.index("qemu-img create")
+    assert vm.spec["chroot"] == str(tmp_path / "vms" / "vm1")
+
+
+def test_vm_provision_script_runs(tmp_path):
+    h = Hypervisor(str(tmp_path))
+    spec = VmSpec({"name": "vm1", "machine": "pc", "drives": ["backing_file=base/missing.qcow2"]})
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        h.vms.create(spec)
+    assert "Image base/missing.qcow2 does not exist" in error.value.stderr
+
+
+def test_vm_clone(tmp_path):
+    (tmp_path / "vms" / "src").mkdir(parents=True)
+    (tmp_path / "vms" / "src" / "spec.json").write_text(json.dumps(VmSpec({
+        "name": "src",
+        "machine": "pc",
+        "uefi": True,
+        "drives": ["disk.qcow2,size=10G", "scratch.raw,size=1G"],
+        "nics": ["br0,mac=52:54:00:00:00:01"],
+    })))
+    h = Hypervisor(str(tmp_path))
+    src = h.vms.get("src")
+    with patch.object(h, "exec") as mock_exec:
+        results = list(h.vms.clone("src", ["dst1", "dst2"]))
+    assert sorted(name for name, error in results) == ["dst1", "dst2"]
+    assert not any(error for name, error in results)
+    clone = h.vms.get("dst1").spec
+    template = os.path.dirname(clone["drives"][0]["backing_file"])
+    snapshot = mock_exec.call_args_list[0][0][0][2]
+    assert f"qemu-img convert -O qcow2 disk.qcow2 {tmp_path}/images/{template}/disk.qcow2" in snapshot
+    assert f"cp --reflink=auto --sparse=always scratch.raw {tmp_path}/images/{template}/scratch.raw" in snapshot
+    assert f"chmod a-w {tmp_path}/images/{template}/disk.qcow2" in snapshot
+    assert "uefi" not in snapshot
+    assert clone["uuid"] != src.spec["uuid"]
+    assert clone["nics"][0]["mac"] != "52:54:00:00:00:01"
+    assert clone["nics"][0]["br"] == "br0"
+    assert [drive["file"] for drive in clone["drives"]] == ["disk.qcow2", "scratch.raw", "uefi_code.fd", "uefi_vars.fd"]
+    assert template.startswith("templates/src-")
+    assert "size" not in clone["drives"][0]
+    assert "backing_file" not in clone["drives"][2]
+    provision = mock_exec.call_args_list[1][0][0][2]
+    assert f"qemu-img create -F qcow2 -b {template}/disk.qcow2 -f qcow2 disk.qcow2" in provision
+    assert f"cp --reflink=auto --sparse=always {template}/scratch.raw scratch.raw" in provision
+
+
+def test_vms_events(tmp_path):
+    h = Hypervisor(str(tmp_path))
+    servers = []
+    for name in ["vm1", "vm2"]:
+        (tmp_path / "vms" / name).mkdir(parents=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(tmp_path / "vms" / name / "qmp.sock"))
+        server.listen(1)
+        servers.append(server)
+
+        def monitor(server=server, name=name):
+            conn, _ = server.accept()
+            with conn, conn.makefile("rwb") as file:
+                file.write(b'{"QMP":{"version":{},"capabilities":[]}}\r\n')
+                file.flush()
+                command = json.loads(file.readline())
+                file.write(json.dumps({"id": command["id"], "return": {}}).encode() + b"\r\n")
+                file.write(json.dumps({"event": "SHUTDOWN", "data": {"vm": name}}).encode() + b"\r\n")
+                file.flush()
+
+        threading.Thread(target=monitor, daemon=True).start()
+    (tmp_path / "vms" / "vm3").mkdir(parents=True)
+    events = list(h.vms.events(h.vms.select(["vm*"]), timeout=5))
+    assert sorted((vm.name, event["data"]["vm"]) for vm, event in events) == [("vm1", "vm1"), ("vm2", "vm2")]
+    for server in servers:
+        server.close()
+
+
+def test_vm_wait_for(tmp_path):
+    (tmp_path / "vms" / "vm1").mkdir(parents=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(tmp_path / "vms" / "vm1" / "qmp.sock"))
+    server.listen(1)
+
+    def monitor():
+        conn, _ = server.accept()
+        with conn, conn.makefile("rwb") as file:
+            file.write(b'{"QMP":{"version":{},"capabilities":[]}}\r\n')
+            file.flush()
+            for line in file:
+                command = json.loads(line)
+                status = {"status": "paused"} if command["execute"] == "query-status" else {}
+                file.write(json.dumps({"id": command["id"], "return": status}).encode() + b"\r\n")
+                file.flush()
+                if command["execute"] == "query-status":
+                    file.write(b'{"event":"RESUME","data":{}}\r\n')
+                    file.flush()
+
+    threading.Thread(target=monitor, daemon=True).start()
+    h = Hypervisor(str(tmp_path))
+    vm = h.vms.get("vm1")
+    assert vm.wait_for("running", timeout=5) is vm
+    assert vm.wait_for("stopped", timeout=1) is vm
+    with pytest.raises(TimeoutError):
+        vm.wait_for("shutdown", timeout=0.2)
+    server.close()